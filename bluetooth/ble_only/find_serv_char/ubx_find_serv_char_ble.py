@@ -1,7 +1,10 @@
 import asyncio
 import sys
+import os
+import json
 import argparse
 import re
+import time
 from bleak import BleakClient, BleakScanner
 from colorama import init, Fore, Style
 
@@ -49,10 +52,162 @@ async def find_service_and_characteristic(device_address):
         print(Fore.RED + f"Error: {e}")
         return None, None
 
+async def read_characteristic(client, char, semaphore):
+    """
+    Reads one characteristic, limiting the number of reads in flight with the semaphore.
+
+    :param client: The BleakClient instance.
+    :param char: The BleakGATTCharacteristic to read.
+    :param semaphore: The asyncio.Semaphore bounding the parallel reads.
+    :return: A dictionary describing the characteristic and its value.
+    """
+    entry = {
+        "uuid": char.uuid,
+        "handle": char.handle,
+        "properties": list(char.properties),
+        "value": None,
+    }
+    if "read" in char.properties:
+        async with semaphore:
+            try:
+                entry["value"] = (await client.read_gatt_char(char)).hex()
+            except Exception as e:
+                entry["error"] = str(e)
+    return entry
+
+async def dump_gatt(device_address, parallel):
+    """
+    Connects to the device and reads all readable characteristics concurrently.
+
+    :param device_address: The MAC address of the BLE device.
+    :param parallel: The maximum number of characteristic reads in flight.
+    :return: The GATT snapshot as a dictionary, or None on error.
+    """
+    try:
+        async with BleakClient(device_address) as client:
+            services = client.services
+            semaphore = asyncio.Semaphore(parallel)
+
+            start_time = time.perf_counter()
+            reads = [[read_characteristic(client, char, semaphore) for char in service.characteristics]
+                     for service in services]
+            results = await asyncio.gather(*(asyncio.gather(*service_reads) for service_reads in reads))
+            elapsed = time.perf_counter() - start_time
+
+            snapshot = {
+                "address": device_address,
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "services": [
+                    {"uuid": service.uuid, "handle": service.handle, "characteristics": characteristics}
+                    for service, characteristics in zip(services, results)
+                ],
+            }
+            # Characteristic UUID -> handle, used as a cache by the send/receive scripts
+            snapshot["handles"] = {
+                char["uuid"]: char["handle"]
+                for service in snapshot["services"] for char in service["characteristics"]
+            }
+
+            count = sum(len(characteristics) for characteristics in results)
+            print(Fore.GREEN + f"Read {count} characteristic(s) in {len(results)} service(s) in {elapsed * 1000:.0f} ms")
+            return snapshot
+
+    except Exception as e:
+        print(Fore.RED + f"Error: {e}")
+        return None
+
+def index_snapshot(snapshot):
+    """
+    Indexes the characteristics of a snapshot by (service UUID, characteristic UUID, handle).
+
+    :param snapshot: The GATT snapshot.
+    :return: A dictionary of characteristic entries.
+    """
+    return {
+        (service["uuid"], char["uuid"], char["handle"]): char
+        for service in snapshot["services"] for char in service["characteristics"]
+    }
+
+def diff_snapshots(previous, current):
+    """
+    Compares two GATT snapshots.
+
+    :param previous: The cached snapshot.
+    :param current: The new snapshot.
+    :return: A list of human-readable differences.
+    """
+    old = index_snapshot(previous)
+    new = index_snapshot(current)
+    changes = []
+    for key in sorted(new.keys() - old.keys()):
+        changes.append(f"Added characteristic {key[1]} (handle {key[2]}) in service {key[0]}")
+    for key in sorted(old.keys() - new.keys()):
+        changes.append(f"Removed characteristic {key[1]} (handle {key[2]}) in service {key[0]}")
+    for key in sorted(old.keys() & new.keys()):
+        if old[key]["properties"] != new[key]["properties"]:
+            changes.append(f"Properties of {key[1]} changed: {old[key]['properties']} -> {new[key]['properties']}")
+        if old[key]["value"] != new[key]["value"]:
+            changes.append(f"Value of {key[1]} changed: {old[key]['value']} -> {new[key]['value']}")
+    return changes
+
+def print_snapshot(snapshot):
+    """
+    Prints a GATT snapshot in the same layout as the sequential walk.
+
+    :param snapshot: The GATT snapshot.
+    """
+    for service in snapshot["services"]:
+        print(Fore.GREEN + f"Service UUID: {service['uuid']}")
+        for char in service["characteristics"]:
+            print(Fore.CYAN + f"    Characteristic UUID: {char['uuid']}")
+            print(Fore.YELLOW + f"        Properties: {char['properties']}")
+            if "error" in char:
+                print(Fore.RED + f"        Value: Could not read ({char['error']})")
+            elif char["value"] is None:
+                print(Fore.MAGENTA + f"        Value: Not readable")
+            else:
+                print(Fore.MAGENTA + f"        Value: {bytes.fromhex(char['value'])}")
+
+async def dump_and_diff(device_address, dump_file, parallel, diff):
+    """
+    Dumps the GATT table to a JSON file, optionally comparing it with the previous dump.
+
+    :param device_address: The MAC address of the BLE device.
+    :param dump_file: The JSON file to write.
+    :param parallel: The maximum number of characteristic reads in flight.
+    :param diff: True to compare the new snapshot with the one already in dump_file.
+    """
+    snapshot = await dump_gatt(device_address, parallel)
+    if snapshot is None:
+        return
+
+    print_snapshot(snapshot)
+
+    if diff:
+        if os.path.exists(dump_file):
+            with open(dump_file, "r") as file:
+                previous = json.load(file)
+            changes = diff_snapshots(previous, snapshot)
+            if changes:
+                print(Fore.YELLOW + f"{len(changes)} change(s) since {previous.get('timestamp')}:")
+                for change in changes:
+                    print(Fore.YELLOW + f"    {change}")
+            else:
+                print(Fore.GREEN + f"No changes since {previous.get('timestamp')}")
+        else:
+            print(Fore.YELLOW + f"No previous snapshot in {dump_file} to compare with")
+
+    with open(dump_file, "w") as file:
+        json.dump(snapshot, file, indent=2)
+    print(Fore.GREEN + f"GATT snapshot saved to {dump_file}")
+
 # Example usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find BLE services and characteristics.")
     parser.add_argument("-a", "--address", required=True, help="MAC address of the BLE device")
+    parser.add_argument("--dump", metavar="FILE", help="Read all characteristics concurrently and save a JSON snapshot to FILE")
+    parser.add_argument("--parallel", type=int, default=4, help="Maximum number of characteristic reads in flight in dump mode (default: 4)")
+    parser.add_argument("--diff", action="store_true", help="Compare the new snapshot with the one already saved in the dump file")
     args = parser.parse_args()
     
     try:
@@ -63,4 +218,7 @@ if __name__ == "__main__":
 
     # Run the async function
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(find_service_and_characteristic(device_address))
\ No newline at end of file
+    if args.dump:
+        loop.run_until_complete(dump_and_diff(device_address, args.dump, args.parallel, args.diff))
+    else:
+        loop.run_until_complete(find_service_and_characteristic(device_address))
\ No newline at end of file
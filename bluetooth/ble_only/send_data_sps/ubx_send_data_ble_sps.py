@@ -13,11 +13,13 @@ except ImportError:
 
 debug = False
 
+ASCII_ALPHABET = (string.ascii_letters + string.digits).encode()
+
 def generate_random_data(length):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    return bytes(random.choices(ASCII_ALPHABET, k=length))
 
 def data_to_hex(data):
-    return ''.join(f"{ord(char):02X}" for char in data)
+    return data.hex().upper()
 
 async def find_service_and_characteristic(client, service_uuid, characteristic_uuid):
     """
@@ -65,10 +67,10 @@ async def read_gatt_char_value(client, data, service_uuid, characteristic_uuid):
 
             # Convert the bytes data to a string and print it
             if debug:
-                print(Fore.GREEN + f"Data read: {data_receive.decode()}")
+                print(Fore.GREEN + f"Data read: {bytes(data_receive).decode(errors='backslashreplace')}")
                 # print(Fore.GREEN + f"Sending data in hex: {data_to_hex(data)}")
 
-            assert data == data_receive.decode(), "Data read does not match data sent"
+            assert data_receive == data, "Data read does not match data sent"
             print(Fore.YELLOW + "Data read matches data sent")
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot read data.")
@@ -86,9 +88,9 @@ async def send_data_via_ble(client, data, service_uuid, characteristic_uuid):
     
     if service_uuid and characteristic_uuid:
         await client.start_notify(characteristic_uuid, notification_handler)
-        await client.write_gatt_char(characteristic_uuid, data.encode())
+        await client.write_gatt_char(characteristic_uuid, data)
         if debug:
-            print(Fore.GREEN + f"Sending data: {data}")
+            print(Fore.GREEN + f"Sending data: {data.decode()}")
             # print(Fore.GREEN + f"Sending data in hex: {data_to_hex(data)}")
 
         # Read and assert the data
@@ -106,9 +108,8 @@ def notification_handler(sender, data):
     :param sender: The sender of the notification.
     :param data: The data received in the notification.
     """
-    hex_data = ' '.join(f"{byte:02X}" for byte in data)
     if debug:
-        print(Fore.YELLOW + f"Notification from {sender}: {hex_data}")
+        print(Fore.YELLOW + f"Notification from {sender}: {data.hex(' ').upper()}")
 
 async def main_ble(target_address):
     """
@@ -22,7 +22,7 @@ async def read_gatt_char_value(client, service_prefix, characteristic_prefix):
             data = await client.read_gatt_char(characteristic_uuid)
 
             # Convert the bytes data to a hex string and print it
-            hex_data = ' '.join(f"{byte:02X}" for byte in data)
+            hex_data = data.hex(' ').upper()
             print(Fore.GREEN + f"Data read: {hex_data}")
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot read data.")
@@ -69,7 +69,7 @@ async def write_gatt_char_value(client, service_prefix, characteristic_prefix, d
         if client.is_connected:
             print(Fore.CYAN + f"Sending {len(data_bytes)} byte(s) to characteristic {characteristic_uuid}...")
             await client.write_gatt_char(characteristic_uuid, data_bytes)
-            hex_data = ' '.join(f"{byte:02X}" for byte in data_bytes)
+            hex_data = data_bytes.hex(' ').upper()
             print(Fore.GREEN + f"Data {hex_data} sent successfully!")
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot send data.")
@@ -86,7 +86,7 @@ def format_mac_address(mac):
     return mac
 
 def data_to_hex(data):
-    return ''.join(f"{byte:02X}" for byte in data)
+    return data.hex().upper()
 
 async def main(target_address):
     service_prefix = "4906276b"
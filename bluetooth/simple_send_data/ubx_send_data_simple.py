@@ -12,23 +12,25 @@ try:
 except ImportError:
     BleakClient = None
 
+ASCII_ALPHABET = (string.ascii_letters + string.digits).encode()
+
 def generate_random_data(length):
     """
-    Generates a random string of the specified length.
+    Generates random letters and digits of the specified length.
 
-    :param length: The length of the random string.
-    :return: A random string of the specified length.
+    :param length: The number of bytes.
+    :return: Random bytes of the specified length.
     """
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    return bytes(random.choices(ASCII_ALPHABET, k=length))
 
 def data_to_hex(data):
     """
-    Converts a string to its hexadecimal representation.
+    Converts bytes to their hexadecimal representation.
 
-    :param data: The string to convert.
-    :return: The hexadecimal representation of the string.
+    :param data: The bytes to convert.
+    :return: The hexadecimal representation of the bytes.
     """
-    return ''.join(f"{ord(char):02X}" for char in data)
+    return data.hex().upper()
 
 def send_data_via_bluetooth_classic(sock, data):
     """
@@ -90,9 +92,9 @@ async def write_gatt_char_ble(client, data, service_uuid, characteristic_uuid):
             data = data[:244]
             print(Fore.YELLOW + "Data length exceeds 244 bytes. See ublox documentation.")
         
-        await client.write_gatt_char(characteristic_uuid, data.encode())
+        await client.write_gatt_char(characteristic_uuid, data)
         hex_data = data_to_hex(data)
-        print(Fore.YELLOW + f"Writing data: {data}")
+        print(Fore.YELLOW + f"Writing data: {data.decode()}")
         print(Fore.GREEN + f"Writing data: {hex_data}")
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot send data.")
@@ -113,8 +115,8 @@ async def read_gatt_char_value(client, service_uuid, characteristic_uuid):
             data = await client.read_gatt_char(characteristic_uuid)
 
             # Convert the bytes data to a hex string and print it
-            hex_data = ' '.join(f"{byte:02X}" for byte in data)
-            print(Fore.YELLOW + f"Data read: {data.decode()}")
+            hex_data = data.hex(' ').upper()
+            print(Fore.YELLOW + f"Data read: {bytes(data).decode(errors='backslashreplace')}")
             print(Fore.GREEN + f"Data read in hex: {hex_data}")
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot read data.")
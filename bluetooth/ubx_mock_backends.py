@@ -0,0 +1,270 @@
+import asyncio
+import socket
+import threading
+import time
+
+# u-blox Serial Port Service (SPS)
+SPS_SERVICE_UUID = "2456e1b9-26e2-8f83-e744-f34f01e9d701"
+SPS_FIFO_UUID = "2456e1b9-26e2-8f83-e744-f34f01e9d703"
+SPS_CREDITS_UUID = "2456e1b9-26e2-8f83-e744-f34f01e9d704"
+
+# User-defined service and characteristic, as configured with +UBTGSER/+UBTGCHA
+CUSTOM_SERVICE_UUID = "4906276b-da6a-4a6c-bf94-c8fb9a8a0001"
+CUSTOM_CHARACTERISTIC_UUID = "49af5250-f17b-4cfd-8a3d-4bdca1c40001"
+CUSTOM_CHARACTERISTIC_MAX_LENGTH = 244
+
+DEFAULT_BLE_MTU = 247
+DEFAULT_RFCOMM_MTU = 990
+
+class LinkModel:
+    """
+    Models the timing of a Bluetooth link.
+
+    Every packet costs a fixed latency, and every byte costs 1 / bandwidth seconds.
+    """
+
+    def __init__(self, mtu, latency=0.0, bandwidth=0):
+        """
+        :param mtu: The maximum packet size in bytes.
+        :param latency: The latency per packet in seconds.
+        :param bandwidth: The link bandwidth in bytes per second (0 for unlimited).
+        """
+        self.mtu = mtu
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def delay(self, length, packets=1):
+        """
+        Returns the time needed to transfer length bytes in the given number of packets.
+
+        :param length: The number of bytes.
+        :param packets: The number of packets.
+        :return: The transfer time in seconds.
+        """
+        return packets * self.latency + (length / self.bandwidth if self.bandwidth else 0)
+
+class FakeCharacteristic:
+    """
+    Stand-in for bleak's BleakGATTCharacteristic. Holds the last value written.
+    """
+
+    def __init__(self, uuid, handle, properties, max_write_without_response_size, max_length=None):
+        self.uuid = uuid
+        self.handle = handle
+        self.properties = properties
+        self.max_write_without_response_size = max_write_without_response_size
+        self.max_length = max_length
+        self.value = b""
+        self.notify_callback = None
+
+class FakeService:
+    """
+    Stand-in for bleak's BleakGATTService.
+    """
+
+    def __init__(self, uuid, handle, characteristics):
+        self.uuid = uuid
+        self.handle = handle
+        self.characteristics = characteristics
+
+class FakeServiceCollection:
+    """
+    Stand-in for bleak's BleakGATTServiceCollection.
+    """
+
+    def __init__(self, services):
+        self.services = services
+
+    def __iter__(self):
+        return iter(self.services)
+
+    def get_characteristic(self, specifier):
+        """
+        Returns the characteristic matching a UUID, handle or characteristic object.
+
+        :param specifier: The UUID, handle or characteristic.
+        :return: The matching FakeCharacteristic, or None if not found.
+        """
+        if isinstance(specifier, FakeCharacteristic):
+            return specifier
+        for service in self.services:
+            for characteristic in service.characteristics:
+                if specifier in (characteristic.uuid, characteristic.handle):
+                    return characteristic
+        return None
+
+class FakeBleakClient:
+    """
+    Local stand-in for bleak.BleakClient talking to a u-blox module.
+
+    It exposes the SPS service with its FIFO and credits characteristics and one
+    user-defined service whose characteristic holds up to 244 bytes. Every
+    characteristic reads back the last value written, and writes to the SPS FIFO
+    are echoed back as notifications. Writes and reads are delayed according to
+    the MTU, per-packet latency and bandwidth of the link model.
+    """
+
+    def __init__(self, address, mtu=DEFAULT_BLE_MTU, latency=0.0, bandwidth=0):
+        """
+        :param address: The target Bluetooth address.
+        :param mtu: The negotiated ATT MTU.
+        :param latency: The latency per ATT packet in seconds.
+        :param bandwidth: The link bandwidth in bytes per second (0 for unlimited).
+        """
+        self.address = address
+        self.link = LinkModel(mtu, latency, bandwidth)
+        self.is_connected = False
+        payload_size = mtu - 3
+        self.services = FakeServiceCollection([
+            FakeService(SPS_SERVICE_UUID, 0x0010, [
+                FakeCharacteristic(SPS_FIFO_UUID, 0x0012, ["read", "write-without-response", "write", "notify"], payload_size),
+                FakeCharacteristic(SPS_CREDITS_UUID, 0x0015, ["read", "write-without-response", "write", "notify"], payload_size),
+            ]),
+            FakeService(CUSTOM_SERVICE_UUID, 0x0020, [
+                FakeCharacteristic(CUSTOM_CHARACTERISTIC_UUID, 0x0022, ["read", "write-without-response", "write"],
+                                   payload_size, CUSTOM_CHARACTERISTIC_MAX_LENGTH),
+            ]),
+        ])
+
+    @property
+    def mtu_size(self):
+        return self.link.mtu
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self):
+        await asyncio.sleep(self.link.delay(0))
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        return True
+
+    def _characteristic(self, specifier):
+        if not self.is_connected:
+            raise ConnectionError("Not connected")
+        characteristic = self.services.get_characteristic(specifier)
+        if characteristic is None:
+            raise ValueError(f"Characteristic {specifier} was not found")
+        return characteristic
+
+    def _packets(self, length):
+        payload_size = self.link.mtu - 3
+        return max(1, -(-length // payload_size))
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        """
+        Writes data to a characteristic.
+
+        :param char_specifier: The characteristic UUID, handle or object.
+        :param data: The data to write.
+        :param response: True for write-with-response, False for write-without-response,
+                         None to pick from the characteristic properties like bleak does.
+        """
+        characteristic = self._characteristic(char_specifier)
+        data = bytes(data)
+        if response is None:
+            response = "write" in characteristic.properties
+        if not response and len(data) > characteristic.max_write_without_response_size:
+            raise ValueError(f"Write without response of {len(data)} bytes exceeds "
+                             f"{characteristic.max_write_without_response_size} bytes")
+        if characteristic.max_length is not None and len(data) > characteristic.max_length:
+            raise ValueError(f"Value of {len(data)} bytes exceeds the characteristic maximum of "
+                             f"{characteristic.max_length} bytes")
+
+        packets = self._packets(len(data))
+        # A write with response waits for the Write Response of every packet
+        await asyncio.sleep(self.link.delay(len(data), packets * 2 if response else packets))
+        characteristic.value = data
+
+        if characteristic.uuid == SPS_FIFO_UUID and characteristic.notify_callback:
+            payload_size = self.link.mtu - 3
+            for i in range(0, len(data), payload_size):
+                characteristic.notify_callback(characteristic, bytearray(data[i:i + payload_size]))
+
+    async def read_gatt_char(self, char_specifier):
+        """
+        Reads the last value written to a characteristic.
+
+        :param char_specifier: The characteristic UUID, handle or object.
+        :return: The characteristic value.
+        """
+        characteristic = self._characteristic(char_specifier)
+        value = characteristic.value
+        # Read Request plus one Read (Blob) Response per packet
+        await asyncio.sleep(self.link.delay(len(value), self._packets(len(value)) + 1))
+        return bytearray(value)
+
+    async def start_notify(self, char_specifier, callback):
+        self._characteristic(char_specifier).notify_callback = callback
+
+    async def stop_notify(self, char_specifier):
+        self._characteristic(char_specifier).notify_callback = None
+
+class FakeRfcommSocket:
+    """
+    Local stand-in for a pybluez RFCOMM BluetoothSocket.
+
+    Data is sent in MTU-sized frames over one end of a socket.socketpair, and a
+    background thread drains the other end like the u-blox module would. Each
+    frame is delayed according to the per-frame latency and bandwidth of the
+    link model.
+    """
+
+    def __init__(self, mtu=DEFAULT_RFCOMM_MTU, latency=0.0, bandwidth=0):
+        """
+        :param mtu: The RFCOMM frame size in bytes.
+        :param latency: The latency per frame in seconds.
+        :param bandwidth: The link bandwidth in bytes per second (0 for unlimited).
+        """
+        self.link = LinkModel(mtu, latency, bandwidth)
+        self.sock, self.peer = socket.socketpair()
+        self.received = 0
+        self.reader = None
+
+    def connect(self, address):
+        """
+        Starts the peer reader. The address is ignored.
+
+        :param address: The (Bluetooth address, port) tuple.
+        """
+        self.reader = threading.Thread(target=self._drain, daemon=True)
+        self.reader.start()
+
+    def _drain(self):
+        buffer = bytearray(65536)
+        while True:
+            count = self.peer.recv_into(buffer)
+            if not count:
+                break
+            self.received += count
+
+    def send(self, data):
+        """
+        Sends data in MTU-sized frames.
+
+        :param data: The data to send (str or bytes).
+        :return: The number of bytes sent.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data)
+        for i in range(0, len(view), self.link.mtu):
+            frame = view[i:i + self.link.mtu]
+            delay = self.link.delay(len(frame))
+            if delay:
+                time.sleep(delay)
+            self.sock.sendall(frame)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+        if self.reader:
+            self.reader.join(timeout=1)
+        self.peer.close()
@@ -1,37 +1,122 @@
-import bluetooth
 import argparse
 import random
 import string
 import asyncio
 import math
+import time
+import json
+import struct
+import zlib
 from colorama import init, Fore, Style
+import ubx_mock_backends
 
 init(autoreset=True)
 
+try:
+    import bluetooth
+    BluetoothError = bluetooth.BluetoothError
+except ImportError:
+    bluetooth = None
+    BluetoothError = OSError
+
 try:
     from bleak import BleakClient, BleakError
 except ImportError:
     BleakClient = None
 
 debug = False
+verify_fragments = False
+capture_path = None
+print_notifications = False
+backend = "real"
+mock_options = {}
+binary_payload = False
+
+# Maximum length of a u-blox user-defined characteristic value
+# Document: u-connectXpress-ATCommands-Manual_UBX-14044127
+# Section: 12.2 GATT Define a characteristic +UBTGCHA
+GATT_MAX_CHAR_LENGTH = 244
+
+# Frame header: sequence number and CRC-32 of the payload
+FRAME_HEADER = struct.Struct("<II")
+
+ASCII_ALPHABET = (string.ascii_letters + string.digits).encode()
 
 def generate_random_data(length):
     """
-    Generates a random string of the specified length.
+    Generates random bytes of the specified length.
+
+    :param length: The number of bytes.
+    :return: Random bytes (letters and digits, or any byte value when binary_payload is set).
+    """
+    if binary_payload:
+        return random.randbytes(length)
+    return bytes(random.choices(ASCII_ALPHABET, k=length))
 
-    :param length: The length of the random string.
-    :return: A random string of the specified length.
+def build_frame(sequence, payload):
     """
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    Prepends the sequence number and the CRC-32 of the payload.
+
+    :param sequence: The frame sequence number.
+    :param payload: The payload bytes.
+    :return: The frame bytes.
+    """
+    return FRAME_HEADER.pack(sequence & 0xFFFFFFFF, zlib.crc32(payload)) + payload
+
+def verify_frame(frame):
+    """
+    Checks the CRC-32 in a frame header against its payload.
+
+    :param frame: The frame bytes.
+    :return: The sequence number and True if the CRC matches.
+    """
+    if len(frame) < FRAME_HEADER.size:
+        return None, False
+    sequence, crc = FRAME_HEADER.unpack_from(frame)
+    return sequence, zlib.crc32(memoryview(frame)[FRAME_HEADER.size:]) == crc
 
 def data_to_hex(data):
     """
-    Converts a string to its hexadecimal representation.
+    Converts bytes to their hexadecimal representation.
+
+    :param data: The bytes to convert.
+    :return: The hexadecimal representation of the bytes.
+    """
+    return data.hex().upper()
+
+def create_ble_client(target_address):
+    """
+    Creates the BLE client for the selected backend.
+
+    :param target_address: The target Bluetooth address.
+    :return: A BleakClient, or a FakeBleakClient with the mock backend.
+    """
+    if backend == "mock":
+        return ubx_mock_backends.FakeBleakClient(target_address, **mock_options)
+    if BleakClient is None:
+        raise ImportError("bleak library is not installed")
+    return BleakClient(target_address)
+
+def create_rfcomm_socket():
+    """
+    Creates the RFCOMM socket for the selected backend.
 
-    :param data: The string to convert.
-    :return: The hexadecimal representation of the string.
+    :return: A pybluez BluetoothSocket, or a FakeRfcommSocket with the mock backend.
     """
-    return ''.join(f"{ord(char):02X}" for char in data)
+    if backend == "mock":
+        return ubx_mock_backends.FakeRfcommSocket(**mock_options)
+    if bluetooth is None:
+        raise ImportError("pybluez library is not installed")
+    return bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+
+async def settle(seconds):
+    """
+    Waits for the u-blox module to process the data. The mock backends need no wait.
+
+    :param seconds: The time to wait in seconds.
+    """
+    if backend != "mock":
+        await asyncio.sleep(seconds)
 
 def send_data_via_bluetooth_classic(sock, data):
     """
@@ -44,8 +129,8 @@ def send_data_via_bluetooth_classic(sock, data):
         # Send data
         sock.send(data)
         if debug:
-            print(Fore.GREEN + f"Sending {len(data)} bytes:\n{data}")
-    except bluetooth.BluetoothError as e:
+            print(Fore.GREEN + f"Sending {len(data)} bytes:\n{bytes(data).decode(errors='backslashreplace')}")
+    except BluetoothError as e:
         print(Fore.RED + f"Bluetooth error: {e}")
 
 async def find_service_and_characteristic(client, service_uuid, characteristic_uuid):
@@ -86,42 +171,213 @@ async def send_data_sps(client, data, characteristic_uuid):
     """
     
     await client.start_notify(characteristic_uuid, notification_handler)
-    await client.write_gatt_char(characteristic_uuid, data.encode())
+    await client.write_gatt_char(characteristic_uuid, data)
     
     if debug:
-        print(Fore.GREEN + f"Sending {len(data)} bytes:\n{data}")
+        print(Fore.GREEN + f"Sending {len(data)} bytes:\n{bytes(data).decode(errors='backslashreplace')}")
 
-    await asyncio.sleep(1)  # Wait for notification
+    await settle(1)  # Wait for notification
     await client.stop_notify(characteristic_uuid)
 
+def get_fragment_size(client, characteristic, response):
+    """
+    Returns the largest payload that fits in a single write to the characteristic.
+
+    :param client: The BleakClient instance.
+    :param characteristic: The BleakGATTCharacteristic to write to.
+    :param response: True for write-with-response, False for write-without-response.
+    :return: The maximum number of bytes per write.
+    """
+    if response:
+        # ATT Write Request header takes 3 bytes of the negotiated MTU
+        fragment_size = client.mtu_size - 3
+    else:
+        fragment_size = characteristic.max_write_without_response_size
+
+    # A u-blox user-defined characteristic never holds more than 244 bytes
+    return max(1, min(fragment_size, GATT_MAX_CHAR_LENGTH))
+
+def split_payload(data, fragment_size):
+    """
+    Splits the data into fragments of at most fragment_size bytes without copying it.
+
+    :param data: The data to split.
+    :param fragment_size: The maximum fragment length.
+    :return: A list of memoryview fragments.
+    """
+    view = memoryview(data)
+    return [view[i:i + fragment_size] for i in range(0, len(view), fragment_size)] or [view]
+
 async def write_data_gatt(client, data, characteristic_uuid):
     """
     Sends data via Bluetooth Low Energy (BLE) for customized services and characteristics.
 
+    Payloads larger than one ATT write are split into MTU-sized fragments. The
+    fragments are pipelined with write-without-response when the characteristic
+    allows it, or written and read back one by one when verify_fragments is set.
+
     :param client: The BleakClient instance.
     :param data: The data to send.
     :param characteristic_uuid: The characteristic UUID to match.
+    :return: The value the characteristic is expected to hold after the write (the last fragment).
     """
-    
-    # Limit the data length to 244 bytes as per u-blox documentation
-    # Document: u-connectXpress-ATCommands-Manual_UBX-14044127
-    # Section: 12.2 GATT Define a characteristic +UBTGCHA
-    assert len(data) <= 244, "Data size exceeds the maximum limit of 244 bytes"
-    
-    await client.write_gatt_char(characteristic_uuid, data.encode())
-    hex_data = data_to_hex(data)
+    characteristic = client.services.get_characteristic(characteristic_uuid)
+    response = verify_fragments or "write-without-response" not in characteristic.properties
+    fragment_size = get_fragment_size(client, characteristic, response)
+    fragments = split_payload(data, fragment_size)
+    reassembled = bytearray()
+
+    start_time = time.perf_counter()
+    for fragment in fragments:
+        await client.write_gatt_char(characteristic, fragment, response=response)
+        if verify_fragments:
+            reassembled += await client.read_gatt_char(characteristic)
+    elapsed = time.perf_counter() - start_time
+
+    if verify_fragments:
+        sequence, crc_ok = verify_frame(reassembled)
+        assert crc_ok, "Reassembled frame CRC does not match"
+        print(Fore.YELLOW + f"Reassembled frame {sequence} ({len(fragments)} fragment(s)) CRC matches")
+
+    throughput = len(data) * 8 / elapsed / 1000 if elapsed > 0 else 0
+    print(Fore.CYAN + f"Wrote {len(data)} bytes in {len(fragments)} fragment(s) of up to {fragment_size} bytes "
+                      f"({'with' if response else 'without'} response): {elapsed * 1000:.2f} ms, {throughput:.2f} kbps")
     if debug:
-        print(Fore.GREEN + f"Sending {len(data)} bytes:\n{hex_data}")
+        print(Fore.GREEN + f"Sending {len(data)} bytes:\n{data_to_hex(data)}")
+
+    return bytes(fragments[-1])
+
+class NotificationSink:
+    """
+    Collects BLE notifications without blocking the bleak callback.
+
+    The callback only queues (timestamp, handle, bytes). A background task writes
+    the queue in batches to a capture file and keeps rate, byte and gap counters.
+    Capture files ending in ".jsonl" get one JSON object per notification, any
+    other name gets packed binary records (float64 timestamp, uint16 handle,
+    uint16 length, data).
+    """
+
+    RECORD_HEADER = struct.Struct("<dHH")
+
+    def __init__(self, capture_path=None, queue_size=4096, batch_size=256, gap_threshold=0.5, verbose=False):
+        self.capture_path = capture_path
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.gap_threshold = gap_threshold
+        self.verbose = verbose
+        self.jsonl = capture_path is not None and capture_path.endswith(".jsonl")
+        self.file = None
+        self.task = None
+        self.count = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.gaps = 0
+        self.max_gap = 0.0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def put(self, sender, data):
+        """
+        Queues a notification. Called from the bleak callback, so it never blocks.
+
+        :param sender: The characteristic (or handle) that sent the notification.
+        :param data: The data received in the notification.
+        """
+        try:
+            self.queue.put_nowait((time.time(), getattr(sender, "handle", sender), bytes(data)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def start(self):
+        """
+        Opens the capture file and starts the background writer task.
+        """
+        if self.capture_path:
+            self.file = open(self.capture_path, "a" if self.jsonl else "ab")
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops the writer task, flushes pending notifications and closes the capture file.
+
+        The writer is stopped with a sentinel on the queue rather than cancelled, so a batch
+        being written in a worker thread is finished before the file is closed.
+        """
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+        # Notifications queued after the sentinel
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._write_batch(batch)
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size or self.queue.empty():
+                    break
+                item = self.queue.get_nowait()
+            if batch:
+                await self._write_batch(batch)
+            if item is None:
+                return  # Sentinel queued by stop()
+
+    async def _write_batch(self, batch):
+        for timestamp, handle, data in batch:
+            if self.last_timestamp is not None:
+                gap = timestamp - self.last_timestamp
+                self.max_gap = max(self.max_gap, gap)
+                if gap > self.gap_threshold:
+                    self.gaps += 1
+            else:
+                self.first_timestamp = timestamp
+            self.last_timestamp = timestamp
+            self.count += 1
+            self.bytes += len(data)
+            if self.verbose:
+                print(Fore.YELLOW + f"Notification from {handle}: {data.hex(' ').upper()}")
+
+        if self.file:
+            if self.jsonl:
+                chunk = "".join(json.dumps({"timestamp": timestamp, "handle": handle, "data": data.hex()}) + "\n"
+                                for timestamp, handle, data in batch)
+            else:
+                chunk = b"".join(self.RECORD_HEADER.pack(timestamp, handle, len(data)) + data
+                                 for timestamp, handle, data in batch)
+            # Keep file I/O off the event loop
+            await asyncio.to_thread(self.file.write, chunk)
+
+    def summary(self):
+        """
+        Returns a one-line summary of the notification counters.
+        """
+        duration = (self.last_timestamp - self.first_timestamp) if self.count > 1 else 0
+        rate = (self.count - 1) / duration if duration > 0 else 0
+        return (f"Notifications: {self.count} ({self.bytes} bytes), {rate:.1f} notifications/s, "
+                f"{self.gaps} gap(s) > {self.gap_threshold} s, max gap {self.max_gap * 1000:.1f} ms, "
+                f"{self.dropped} dropped")
+
+notification_sink = None
 
 def notification_handler(sender, data):
     """
-    Handles notifications from the BLE device.
+    Handles notifications from the BLE device by queueing them on the notification sink.
 
     :param sender: The sender of the notification.
     :param data: The data received in the notification.
     """
-    hex_data = ' '.join(f"{byte:02X}" for byte in data)
-    print(Fore.YELLOW + f"Notification from {sender}: {hex_data}")
+    if notification_sink is not None:
+        notification_sink.put(sender, data)
 
 async def write_gatt_char_ble(client, data, service_uuid, characteristic_uuid):
     """
@@ -131,6 +387,7 @@ async def write_gatt_char_ble(client, data, service_uuid, characteristic_uuid):
     :param data: The data to send.
     :param service_uuid: The service UUID to match.
     :param characteristic_uuid: The characteristic UUID to match.
+    :return: The value expected on read-back, or None if nothing was sent.
     """
     service_uuid, characteristic_uuid = await find_service_and_characteristic(client, service_uuid, characteristic_uuid)
     
@@ -138,19 +395,31 @@ async def write_gatt_char_ble(client, data, service_uuid, characteristic_uuid):
         # Check if the service and characteristic UUIDs start with "2456e1b9"
         if service_uuid.startswith("2456e1b9") and characteristic_uuid.startswith("2456e1b9"):
             await send_data_sps(client, data, characteristic_uuid)
+            return data
         else:
-            await write_data_gatt(client, data, characteristic_uuid)
+            return await write_data_gatt(client, data, characteristic_uuid)
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot send data.")
+        return None
 
-async def read_gatt_char_value(client, data, service_uuid, characteristic_uuid, sps=False):
+async def read_gatt_char_value(client, data, service_uuid, characteristic_uuid, sequence=None, sps=False):
     """
     Finds the matching service and characteristic and reads data from the Bluetooth device.
 
+    A whole frame read back is checked against the CRC-32 in its own header and the
+    sequence number sent. The last fragment of a fragmented frame is compared byte for byte.
+
     :param client: The BleakClient instance.
+    :param data: The value the characteristic is expected to hold.
     :param service_uuid: The service UUID to match.
     :param characteristic_uuid: The characteristic UUID to match.
+    :param sequence: The sequence number of the frame when data is a whole frame, or None.
+    :param sps: True to print the read data as characters instead of hex.
+    :return: True if the data read matches.
     """
+    if data is None:
+        return False
+
     service_uuid, characteristic_uuid = await find_service_and_characteristic(client, service_uuid, characteristic_uuid)
 
     if service_uuid and characteristic_uuid:
@@ -159,20 +428,32 @@ async def read_gatt_char_value(client, data, service_uuid, characteristic_uuid,
                 print(Fore.CYAN + f"Reading data from characteristic {characteristic_uuid}...")
             data_receive = await client.read_gatt_char(characteristic_uuid)
 
-            assert data == data_receive.decode(), "Data read does not match data sent"
-            print(Fore.YELLOW + "Data read matches data sent")
-            if sps:
-                # Convert the bytes data to a string and print it
-                data_receive = data_receive.decode()
-                if debug:
-                    print(Fore.GREEN + f"Data read: {data_receive}")
+            if sequence is not None:
+                received_sequence, crc_ok = verify_frame(data_receive)
+                assert len(data_receive) == len(data) and crc_ok and received_sequence == sequence, \
+                    "Frame read does not match frame sent"
+                print(Fore.YELLOW + f"Frame {sequence} read back, CRC matches")
             else:
-                # Convert the bytes data to a hex string and print it
-                hex_data = ' '.join(f"{byte:02X}" for byte in data_receive)
-                if debug:
-                    print(Fore.GREEN + f"Data read: {hex_data}")
+                assert data_receive == data, "Data read does not match data sent"
+                print(Fore.YELLOW + "Data read matches data sent")
+            if debug:
+                if sps:
+                    print(Fore.GREEN + f"Data read: {bytes(data_receive).decode(errors='backslashreplace')}")
+                else:
+                    print(Fore.GREEN + f"Data read: {data_receive.hex(' ').upper()}")
+            return True
     else:
         print(Fore.RED + "Service or characteristic not found. Cannot read data.")
+    return False
+
+def whole_frame_sequence(expected, frame, sequence):
+    """
+    :param expected: The value the characteristic is expected to hold after the write.
+    :param frame: The frame written.
+    :param sequence: The sequence number of the frame.
+    :return: The sequence number if the characteristic holds the whole frame, None if it only holds the last fragment.
+    """
+    return sequence if expected is not None and len(expected) == len(frame) else None
 
 async def main_ble(target_address, service_uuid, characteristic_uuid, max_data_size, xtimes):
     """
@@ -184,28 +465,36 @@ async def main_ble(target_address, service_uuid, characteristic_uuid, max_data_s
     :param max_data_size: The maximum number of data to generate.
     :param xtimes: The number of times the script should run.
     """
+    global notification_sink
+    notification_sink = NotificationSink(capture_path, verbose=print_notifications)
+    await notification_sink.start()
+
     try:
         # assert max_data_size <= 4148, "Data size exceeds the maximum limit of 4148 bytes"
 
-        if BleakClient is None:
-            raise ImportError("bleak library is not installed")
-        
-        async with BleakClient(target_address) as client:
+        async with create_ble_client(target_address) as client:
             print(Fore.CYAN + f"Connected to {target_address} via BLE")
 
             if xtimes == 0:
-                data = generate_random_data(max_data_size)
-                await write_gatt_char_ble(client, data, service_uuid, characteristic_uuid)
-                await read_gatt_char_value(client, data, service_uuid, characteristic_uuid, True)
+                data = build_frame(0, generate_random_data(max_data_size))
+                expected = await write_gatt_char_ble(client, data, service_uuid, characteristic_uuid)
+                await read_gatt_char_value(client, expected, service_uuid, characteristic_uuid,
+                                           whole_frame_sequence(expected, data, 0), sps=True)
             else:
+                sequence = 0
                 for i in range(1, max_data_size + 1):
                     for _ in range(xtimes):
-                        data = generate_random_data(i)
-                        await write_gatt_char_ble(client, data, service_uuid, characteristic_uuid)
-                        await read_gatt_char_value(client, data, service_uuid, characteristic_uuid)
-                        await asyncio.sleep(1)
+                        data = build_frame(sequence, generate_random_data(i))
+                        expected = await write_gatt_char_ble(client, data, service_uuid, characteristic_uuid)
+                        await read_gatt_char_value(client, expected, service_uuid, characteristic_uuid,
+                                                   whole_frame_sequence(expected, data, sequence))
+                        sequence += 1
+                        await settle(1)
     except Exception as e:
         print(Fore.RED + f"BLE error: {e}")
+    finally:
+        await notification_sink.stop()
+        print(Fore.CYAN + notification_sink.summary())
 
 async def main_classic(target_address, port, max_data_size, xtimes):
     """
@@ -219,7 +508,7 @@ async def main_classic(target_address, port, max_data_size, xtimes):
 
     div_data = 2500
     # Create a Bluetooth socket
-    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    sock = create_rfcomm_socket()
     
     try:
         # Connect to the target Bluetooth device
@@ -228,16 +517,18 @@ async def main_classic(target_address, port, max_data_size, xtimes):
             print(Fore.CYAN + f"Connected to {target_address} on port {port}")
         
         if xtimes == 0:
-            data = generate_random_data(max_data_size)
+            data = build_frame(0, generate_random_data(max_data_size))
             send_data_via_bluetooth_classic(sock, data)
-            await asyncio.sleep(math.ceil(len(data) / div_data) + 1) # Wait for data to be read by u-blox module
+            await settle(math.ceil(len(data) / div_data) + 1) # Wait for data to be read by u-blox module
         else:
+            sequence = 0
             for i in range(1, max_data_size + 1):
                 for _ in range(xtimes):
-                    data = generate_random_data(i)
+                    data = build_frame(sequence, generate_random_data(i))
+                    sequence += 1
                     send_data_via_bluetooth_classic(sock, data)
-                    await asyncio.sleep(math.ceil(len(data) / div_data) + 1) # Wait for data to be read by u-blox module
-    except bluetooth.BluetoothError as e:
+                    await settle(math.ceil(len(data) / div_data) + 1) # Wait for data to be read by u-blox module
+    except BluetoothError as e:
         print(Fore.RED + f"Bluetooth error: {e}")
     finally:
         # Close the socket
@@ -262,13 +553,31 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--type", choices=["classic", "ble"], required=True, help="Type of Bluetooth connection (classic or ble)")
     parser.add_argument("--data_size", type=int, required=True, help="Maximum number of characters to send")
     parser.add_argument("--xtimes", type=int, required=True, help="Number of times the script should run for each data size")
+    parser.add_argument("--service", default=ubx_mock_backends.SPS_SERVICE_UUID, help="GATT service UUID to write to (BLE, default: SPS service)")
+    parser.add_argument("--characteristic", default=ubx_mock_backends.SPS_FIFO_UUID, help="GATT characteristic UUID to write to (BLE, default: SPS FIFO characteristic)")
+    parser.add_argument("--verify_fragments", action="store_true", help="Read back every GATT fragment and verify the reassembled data")
+    parser.add_argument("--capture", help="Write BLE notifications to this file (.jsonl for JSON lines, binary otherwise)")
+    parser.add_argument("--print_notifications", action="store_true", help="Print every BLE notification in hex")
+    parser.add_argument("--backend", choices=["real", "mock"], default="real", help="Use the Bluetooth adapter (real) or the local stand-in backends (mock)")
+    parser.add_argument("--mock_mtu", type=int, help="Mock backend MTU in bytes (default: 247 for BLE, 990 for classic)")
+    parser.add_argument("--mock_latency", type=float, default=0.0, help="Mock backend latency per packet in seconds (default: 0)")
+    parser.add_argument("--mock_bandwidth", type=int, default=0, help="Mock backend bandwidth in bytes per second (default: 0, unlimited)")
+    parser.add_argument("--binary", action="store_true", help="Send random binary payloads instead of letters and digits")
     parser.add_argument("--debug", action="store_true", help="Enable debug messages")
     args = parser.parse_args()
     
     debug = args.debug
+    verify_fragments = args.verify_fragments
+    capture_path = args.capture
+    print_notifications = args.print_notifications
+    backend = args.backend
+    binary_payload = args.binary
+    mock_options = {"latency": args.mock_latency, "bandwidth": args.mock_bandwidth}
+    if args.mock_mtu:
+        mock_options["mtu"] = args.mock_mtu
     
-    service_uuid = "2456e1b9-26e2-8f83-e744-f34f01e9d701"
-    characteristic_uuid = "2456e1b9-26e2-8f83-e744-f34f01e9d703"
+    service_uuid = args.service.lower()
+    characteristic_uuid = args.characteristic.lower()
 
     target_address = format_mac_address(args.address)
     port = 1  # Commonly used port for RFCOMM
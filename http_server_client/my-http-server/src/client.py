@@ -2,7 +2,20 @@ import requests
 import time
 from datetime import datetime
 import os
+import argparse
+import json
+import csv
+import math
+import uuid
+import socket
+import hashlib
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
 from colorama import Fore, Style, init
+from payload import iter_payload, payload_block, payload_sha256
+from result_records import make_record, append_records, load_records, save_npz
 
 N = 100  # Number of times to run the download process
 host_ip_address = "192.168.0.115"
@@ -13,12 +26,363 @@ power_mode_config = "AT+UWCFG=1,0" # 0: Wi-Fi ACTIVE mode
                                    # 1: Wi-Fi STANDBY mode
                                    # 2 (default): Wi-Fi SLEEP mode
 
+# Connection handling between downloads
+connection_mode = "pooled"  # pooled: reuse one keep-alive connection (requests.Session)
+                            # new: open a new TCP connection for every download
+
+# HTTP engine of the downloads
+http_engine = "requests"  # requests: requests.Session, one figure per download
+                          # http.client: per-phase timing (DNS, connect, request, wait, body) with perf_counter_ns
+
+# Streaming download
+chunk_size = 64 * 1024  # Bytes read per iter_content chunk
+stall_threshold_ms = 200  # Gap between chunks counted as a stall
+save_images = True  # Write the received images to rec_images (False: discard them)
+timeline_enabled = False  # Write the per-chunk time/bytes series of every download
+
+# Verify mode: check every download against the SHA-256 in the server's /manifest.json instead of writing it
+verify_downloads = False
+keep_copies = 0  # Number of verified copies of each image still written to rec_images (after the timed transfer)
+
+# Segmented download: number of parallel Range requests per image (1: single stream)
+segments = 1
+
+# Generated payload sweep: sizes from /gen/<bytes>?seed=N on a log scale, checked by SHA-256
+gen_sweep = None  # (min bytes, max bytes, number of sizes)
+gen_seed = 0
+
+# Upload mode: generated payloads of these sizes are sent to the server's /upload sink
+upload_sizes = []
+upload_sink = "discard"  # discard: count the bytes, sha256: also hash them (checked against the payload)
+chunked_upload = False  # Send the bodies with Transfer-Encoding: chunked instead of Content-Length
+
+# Raw TCP mode: iperf-style test against the server's --tcp_port, without HTTP
+tcp_direction = None  # download: the server sends, upload: the server receives
+tcp_port = 5201
+tcp_duration = 10  # Seconds per test
+tcp_interval_ms = 500  # Throughput report interval
+
+# Results: one JSON line per transfer (see result_records.RESULT_FIELDS)
+text_results = False  # Also write the human-readable text blocks to results/*.txt
+npz_sidecar = False  # Also write a NumPy .npz copy of every results file (needs numpy)
+
+# Load mode: number of concurrent download workers per level (e.g. [1, 2, 4, 8])
+load_levels = []
+
 images_list = ["image_33kb.jpg", "image_53kb.jpg", "image_100kb.jpg", "image_500kb.jpg",
                "image_1mb.jpg", "image_5mb.jpg", "image_10mb.jpg", "image_20mb.jpg"]
 
 init(autoreset=True)
 
-def fetch_image(image_url, image_name, result_file):
+# Serializes result file writes from the load mode workers
+results_lock = threading.Lock()
+
+def stream_download(image_url, session=None, file_path=None, headers=None, digest=None, keep_body=False):
+  """
+  Downloads a URL chunk by chunk, so memory use stays flat for any image size.
+
+  :param image_url: The URL to download.
+  :param session: The requests.Session to reuse, or None for a new connection.
+  :param file_path: Where to write the body, or None to discard it.
+  :param headers: Extra request headers (e.g. Range).
+  :param digest: A hashlib object updated with the body, or None.
+  :param keep_body: True to hold on to the received chunks, so they can be written after the timed transfer.
+  :return: A dictionary with the status code, received bytes, timings, the
+           per-chunk timeline [(seconds since the request, cumulative bytes), ...]
+           and the body chunks (None unless keep_body is set).
+  """
+  received = 0
+  timeline = []
+  body = [] if keep_body else None
+
+  headers = dict(headers or {})
+  start = time.perf_counter()
+  # Fetch the image, reusing the pooled connection if there is one
+  if session is not None:
+    response = session.get(image_url, stream=True, headers=headers)
+  else:
+    headers['Connection'] = 'close'
+    response = requests.get(image_url, stream=True, headers=headers)
+
+  with response:
+    headers_time = time.perf_counter() - start
+    if response.status_code in (200, 206):
+      file = open(file_path, 'wb') if file_path else None
+      try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+          received += len(chunk)
+          timeline.append((time.perf_counter() - start, received))
+          if file:
+            file.write(chunk)
+          if digest:
+            digest.update(chunk)
+          if body is not None:
+            body.append(chunk)
+      finally:
+        if file:
+          file.close()
+  elapsed = time.perf_counter() - start
+
+  stalls = find_stalls(timeline)
+  return {
+    'status_code': response.status_code,
+    'received': received,
+    'elapsed': elapsed,
+    'headers_time': headers_time,
+    'ttfb': timeline[0][0] if timeline else elapsed,
+    'stalls': len(stalls),
+    'max_stall': max(stalls, default=0),
+    'timeline': timeline,
+    'body': body,
+  }
+
+def find_stalls(timeline):
+  """
+  Finds the gaps between chunks longer than the stall threshold.
+
+  :param timeline: The per-chunk timeline [(seconds since the request, cumulative bytes), ...].
+  :return: The stall durations in seconds.
+  """
+  gaps = [b[0] - a[0] for a, b in zip(timeline, timeline[1:])]
+  return [gap for gap in gaps if gap * 1000 > stall_threshold_ms]
+
+class PhasedConnection:
+  """
+  Keep-alive connection of the http.client engine, opened by the first download.
+  """
+
+  def __init__(self):
+    self.connection = None
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+def new_session():
+  """
+  Opens the keep-alive connection of the pooled mode for the selected engine.
+
+  :return: A requests.Session or a PhasedConnection, or None in the new connection mode.
+  """
+  if connection_mode != "pooled":
+    return None
+  return PhasedConnection() if http_engine == "http.client" else requests.Session()
+
+def phased_download(image_url, pool=None, file_path=None, headers=None, digest=None, keep_body=False):
+  """
+  Downloads a URL with http.client, timing every phase with perf_counter_ns.
+
+  The phases are name resolution and TCP connect (zero on a reused connection),
+  sending the request, waiting for the response headers, and receiving the body.
+
+  :param image_url: The URL to download.
+  :param pool: The PhasedConnection to reuse, or None for a new connection.
+  :param file_path: Where to write the body, or None to discard it.
+  :param headers: Extra request headers.
+  :param digest: A hashlib object updated with the body, or None.
+  :param keep_body: True to hold on to the received chunks, so they can be written after the timed transfer.
+  :return: The same dictionary as stream_download, plus 'phases' with the phase durations in ms.
+  """
+  url = urlsplit(image_url)
+  path = url.path + (f'?{url.query}' if url.query else '')
+  headers = dict(headers or {})
+  headers['Host'] = url.netloc
+  if pool is None:
+    headers['Connection'] = 'close'
+
+  start = time.perf_counter_ns()
+  connection = pool.connection if pool is not None else None
+  reused = connection is not None
+  dns_ns = connect_ns = 0
+  while True:
+    if connection is None:
+      resolve_start = time.perf_counter_ns()
+      address = socket.getaddrinfo(url.hostname, url.port or 80, type=socket.SOCK_STREAM)[0][4]
+      connect_start = time.perf_counter_ns()
+      connection = http.client.HTTPConnection(address[0], address[1])
+      connection.connect()
+      connect_end = time.perf_counter_ns()
+      dns_ns, connect_ns = connect_start - resolve_start, connect_end - connect_start
+    request_start = time.perf_counter_ns()
+    try:
+      connection.request('GET', path, headers=headers)
+      request_sent = time.perf_counter_ns()
+      response = connection.getresponse()
+      break
+    except (http.client.RemoteDisconnected, ConnectionError):
+      if not reused:
+        raise
+      # The server closed the idle keep-alive connection: retry once on a new one
+      connection.close()
+      connection = None
+      reused = False
+  headers_received = time.perf_counter_ns()
+
+  received = 0
+  timeline = []
+  body = [] if keep_body else None
+  buffer = memoryview(bytearray(chunk_size))
+  file = open(file_path, 'wb') if file_path and response.status == 200 else None
+  try:
+    while count := response.readinto(buffer):
+      received += count
+      timeline.append(((time.perf_counter_ns() - start) / 1e9, received))
+      chunk = buffer[:count]
+      if file:
+        file.write(chunk)
+      if digest:
+        digest.update(chunk)
+      if body is not None:
+        body.append(bytes(chunk))
+  finally:
+    if file:
+      file.close()
+  end = time.perf_counter_ns()
+
+  if pool is not None:
+    pool.connection = None if response.will_close else connection
+  if pool is None or response.will_close:
+    connection.close()
+
+  elapsed = (end - start) / 1e9
+  stalls = find_stalls(timeline)
+  return {
+    'status_code': response.status,
+    'received': received,
+    'elapsed': elapsed,
+    'headers_time': (headers_received - start) / 1e9,
+    'ttfb': timeline[0][0] if timeline else elapsed,
+    'stalls': len(stalls),
+    'max_stall': max(stalls, default=0),
+    'timeline': timeline,
+    'body': body,
+    'phases': {
+      'dns_ms': dns_ns / 1e6,
+      'connect_ms': connect_ns / 1e6,
+      'request_ms': (request_sent - request_start) / 1e6,
+      'wait_ms': (headers_received - request_sent) / 1e6,
+      'body_ms': (end - headers_received) / 1e6,
+    },
+  }
+
+def fetch_manifest():
+  """
+  Gets the size and SHA-256 of every image from the server's /manifest.json.
+
+  :return: A dictionary of image name -> {"size": bytes, "sha256": hex digest}.
+  """
+  response = requests.get(f'http://{host_ip_address}:{port}/manifest.json')
+  response.raise_for_status()
+  return response.json()
+
+class UploadBody:
+  """
+  Generated payload streamed as a request body. len() lets requests send a Content-Length.
+  """
+
+  def __init__(self, size, seed):
+    self.size = size
+    self.seed = seed
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    return iter_payload(self.size, self.seed)
+
+def upload_payload(upload_url, size, session=None, headers=None):
+  """
+  Uploads a generated payload chunk by chunk and waits for the server to consume it.
+
+  :param upload_url: The /upload URL of the server.
+  :param size: The payload size in bytes.
+  :param session: The requests.Session to reuse, or None for a new connection.
+  :param headers: Extra request headers.
+  :return: The same dictionary as stream_download, with the bytes and SHA-256 reported by the server.
+  """
+  body = UploadBody(size, gen_seed)
+  # A plain iterator has no length, so requests sends it chunked
+  data = iter(body) if chunked_upload else body
+
+  headers = dict(headers or {})
+  headers['Content-Type'] = 'application/octet-stream'
+  start = time.perf_counter()
+  if session is not None:
+    response = session.put(upload_url, data=data, headers=headers)
+  else:
+    headers['Connection'] = 'close'
+    response = requests.put(upload_url, data=data, headers=headers)
+  elapsed = time.perf_counter() - start
+
+  reply = response.json() if response.status_code == 200 else {}
+  return {
+    'status_code': response.status_code,
+    'received': reply.get('received', 0),
+    'elapsed': elapsed,
+    'headers_time': elapsed,
+    'ttfb': elapsed,  # The server answers once the whole body is consumed
+    'stalls': 0,
+    'max_stall': 0,
+    'timeline': [],
+    'sha256': reply.get('sha256'),
+  }
+
+def segmented_download(image_url, segment_count, session=None, request_id=None):
+  """
+  Downloads a URL as parallel Range requests, one connection per segment. The body is discarded.
+
+  :param image_url: The URL to download.
+  :param segment_count: The number of segments.
+  :param session: The requests.Session used to get the size, or None.
+  :param request_id: The request ID; the HEAD request and the segments send <request_id>-head and <request_id>-<index>.
+  :return: The same dictionary as stream_download, for the whole image.
+  """
+  request_id = request_id or uuid.uuid4().hex
+  start = time.perf_counter()
+  head = (session or requests).head(image_url, headers={'X-Request-ID': f'{request_id}-head'})
+  if head.status_code != 200:
+    return {'status_code': head.status_code, 'received': 0, 'elapsed': time.perf_counter() - start,
+            'headers_time': 0, 'ttfb': 0, 'stalls': 0, 'max_stall': 0, 'timeline': []}
+  size = int(head.headers['Content-Length'])
+
+  bounds = [size * i // segment_count for i in range(segment_count + 1)]
+  ranges = [(a, b - 1) for a, b in zip(bounds, bounds[1:]) if b > a]
+  with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+    parts = list(executor.map(
+      lambda part: stream_download(image_url, headers={'Range': f'bytes={part[1][0]}-{part[1][1]}',
+                                                       'X-Request-ID': f'{request_id}-{part[0]}'}), enumerate(ranges)))
+  elapsed = time.perf_counter() - start
+
+  complete = all(part['status_code'] == 206 for part in parts)
+  received = sum(part['received'] for part in parts)
+  return {
+    'status_code': 200 if complete and received == size else next(
+      (part['status_code'] for part in parts if part['status_code'] != 206), 206),
+    'received': received,
+    'elapsed': elapsed,
+    'headers_time': min(part['headers_time'] for part in parts),
+    'ttfb': min(part['ttfb'] for part in parts),
+    'stalls': sum(part['stalls'] for part in parts),
+    'max_stall': max(part['max_stall'] for part in parts),
+    'timeline': [],
+  }
+
+def fetch_image(image_url, image_name, result_file, session=None, concurrency=1, expected_sha256=None, upload_size=None,
+                keep_path=None):
+  """
+  Runs one transfer and appends its result record: a download, or an upload if upload_size is given.
+
+  :param image_url: The URL of the image, or the /upload URL.
+  :param image_name: The image name, or the name of the uploaded payload.
+  :param result_file: The result file name.
+  :param session: The requests.Session to reuse, or None for a new connection.
+  :param concurrency: The number of concurrent workers of the load mode.
+  :param expected_sha256: The expected SHA-256 of the body, or None.
+  :param upload_size: The size of the generated payload to upload, or None to download.
+  :param keep_path: Where to write the body once the timed transfer is over, or None (verify mode).
+  :return: The dictionary returned by stream_download.
+  """
   # Ensure the results directory exists
   results_dir = 'results'
   if not os.path.exists(results_dir):
@@ -33,55 +397,443 @@ def fetch_image(image_url, image_name, result_file):
   result_file_path = os.path.join(results_dir, result_file)
   
   # Update the image file path to include the rec_images directory
-  image_file_path = os.path.join(rec_images_dir, image_name)
+  # (concurrent workers would overwrite each other's copy, so the load mode discards the images)
+  # (segmented downloads are discarded too)
+  # (the verify mode only hashes the body while receiving it)
+  image_file_path = os.path.join(rec_images_dir, image_name) if (
+    save_images and not verify_downloads and concurrency == 1 and upload_size is None) else None
   
   # Get the start time
   start_time = time.time()
   formatted_start_time = datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S:%f')
   print(f'{Fore.GREEN}Start time:\t{formatted_start_time}')
 
-  # Fetch the image
-  response = requests.get(image_url)
+  # The content is checked only when the body arrives in order
+  digest = hashlib.sha256() if expected_sha256 and segments == 1 else None
+  # Sent as X-Request-ID, so the download can be joined with the server timing log
+  request_id = uuid.uuid4().hex
+  if upload_size is not None:
+    download = upload_payload(image_url, upload_size, session, headers={'X-Request-ID': request_id})
+    received_sha256 = download['sha256']  # Hashed by the server with the sha256 sink
+  elif segments > 1:
+    download = segmented_download(image_url, segments, session, request_id)
+    received_sha256 = None
+  else:
+    download = (phased_download if http_engine == "http.client" else stream_download)(
+      image_url, session, image_file_path, headers={'X-Request-ID': request_id}, digest=digest, keep_body=keep_path is not None)
+    received_sha256 = digest.hexdigest() if digest else None
+    if keep_path and download['status_code'] == 200:
+      # Written after the timer stopped, so the disk stays out of the measurement
+      with open(keep_path, 'wb') as file:
+        file.writelines(download['body'])
+    download['body'] = None
 
-  # Get the end time
-  end_time = time.time()
-    
-  if response.status_code == 200:
-    with open(image_file_path, 'wb') as file:
-        file.write(response.content)
-    # print(f'Image saved to {image_file_path}') # For debug
+  if received_sha256 is None or expected_sha256 is None:
+    download['content_check'] = 'skipped'
+  elif received_sha256 == expected_sha256:
+    download['content_check'] = 'ok'
+  else:
+    download['content_check'] = 'mismatch'
+    print(f'{Fore.RED}Content check failed for {image_name}: SHA-256 {received_sha256} expected {expected_sha256}')
     
+  if download['status_code'] == 200:
     # Calculate transfer time and throughput
-    transfer_time = (end_time - start_time) * 1000  # in milliseconds
-    image_size = len(response.content)  # in bytes
+    transfer_time = download['elapsed'] * 1000  # in milliseconds
+    image_size = download['received']  # in bytes
     image_size_kb = image_size / 1024  # in kilobytes
-    throughput = (image_size * 8) / (end_time - start_time) / (1024 * 1024)  # in Mbps
+    throughput = (image_size * 8) / download['elapsed'] / (1024 * 1024)  # in Mbps
+    # Phase breakdown of the http.client engine
+    phases = download.get('phases', {})
+    body_throughput = (image_size * 8) / (phases['body_ms'] / 1000) / (1024 * 1024) if phases.get('body_ms') else 0.0
+
+    record = make_record(
+      timestamp=start_time,
+      start_time=formatted_start_time,
+      request_id=request_id,
+      direction='downlink' if upload_size is None else 'uplink',
+      image=image_name,
+      size_bytes=image_size,
+      power_mode=power_mode_config,
+      connection_mode=connection_mode,
+      concurrency=concurrency,
+      segments=segments if upload_size is None else 1,
+      http_engine='http.client' if phases else 'requests',
+      transfer_time_ms=transfer_time,
+      ttfb_ms=download['ttfb'] * 1000,
+      **phases,
+      stalls=download['stalls'],
+      max_stall_ms=download['max_stall'] * 1000,
+      throughput_mbps=throughput,
+      body_throughput_mbps=body_throughput,
+      content_check=download['content_check'],
+    )
     
     result = (
         f'***************************************************\n'
         f'NINA Power mode configuration: {power_mode_config}\n'
-        f'Download image {image_name}\n'
+        f'Connection mode: {connection_mode}\n'
+        f'Concurrency: {concurrency}\n'
+        f'Segments: {segments}\n'
+        f'{"Download" if upload_size is None else "Upload"} image {image_name}\n'
         f'Start time: {formatted_start_time}\n'
+        f'Request ID: {request_id}\n'
         f'Transfer time: {transfer_time:.2f} milliseconds\n'
+        f'Time to first byte: {download["ttfb"] * 1000:.2f} milliseconds\n'
+        f'Stalls over {stall_threshold_ms} ms: {download["stalls"]} (longest {download["max_stall"] * 1000:.2f} milliseconds)\n'
         f'Throughput: {throughput:.2f} Mbps\n'
-        f'Received data: {image_size_kb:.2f} kB\n'
+        + (f'Phases: DNS {phases["dns_ms"]:.3f} / connect {phases["connect_ms"]:.3f} / request {phases["request_ms"]:.3f} / '
+           f'wait {phases["wait_ms"]:.3f} / body {phases["body_ms"]:.3f} milliseconds\n'
+           f'Body throughput: {body_throughput:.2f} Mbps\n' if phases else '') +
+        f'{"Received" if upload_size is None else "Sent"} data: {image_size_kb:.2f} kB\n'
+        f'Content check: {download["content_check"]}\n'
         f'***************************************************\n\n'
     )
     
     # print(result)  # For debug
     
-    with open(result_file_path, 'a') as file:
-        file.write(result)
+    with results_lock:
+      append_records(result_file_path, [record])
+      if text_results:
+        with open(os.path.splitext(result_file_path)[0] + '.txt', 'a') as file:
+            file.write(result)
+
+      if timeline_enabled:
+        # One line per download with the throughput-over-time curve
+        timeline_path = os.path.splitext(result_file_path)[0] + '_timeline.jsonl'
+        with open(timeline_path, 'a') as file:
+          file.write(json.dumps({
+            'start_time': formatted_start_time,
+            'image': image_name,
+            'concurrency': concurrency,
+            'ttfb_ms': download['ttfb'] * 1000,
+            'points': [[round(t * 1000, 3), size] for t, size in download['timeline']],
+          }) + '\n')
   else:
-    print(f'{Fore.RED}Failed to fetch image. Status code: {response.status_code}')
+    print(f'{Fore.RED}Failed to fetch image. Status code: {download["status_code"]}')
+
+  return download
+
+def write_npz_sidecar(result_file):
+  """
+  Writes the .npz copy of a results file, if enabled.
+
+  :param result_file: The results file name.
+  """
+  result_file_path = os.path.join('results', result_file)
+  if npz_sidecar and os.path.exists(result_file_path):
+    save_npz(os.path.splitext(result_file_path)[0] + '.npz', load_records(result_file_path))
+
+def percentile(values, fraction):
+  """
+  Nearest-rank percentile of a list of values.
+
+  :param values: The values.
+  :param fraction: The percentile as a fraction (0.9 for p90).
+  :return: The percentile, or 0 for an empty list.
+  """
+  if not values:
+    return 0
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def run_load_level(image_url, image_name, result_file, concurrency, expected_sha256=None, upload_size=None):
+  """
+  Runs concurrent download (or upload) workers against the server, each transferring the image N times.
+
+  :param image_url: The URL of the image.
+  :param image_name: The image name.
+  :param result_file: The result file name.
+  :param concurrency: The number of concurrent workers.
+  :param expected_sha256: The expected SHA-256 of the body, or None.
+  :param upload_size: The size of the generated payload to upload, or None to download.
+  :return: A dictionary with the per-request latencies and the aggregate throughput.
+  """
+  def worker():
+    downloads = []
+    session = new_session()
+    try:
+      for _ in range(N):
+        downloads.append(fetch_image(image_url, image_name, result_file, session, concurrency, expected_sha256, upload_size))
+    finally:
+      if session is not None:
+        session.close()
+    return downloads
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = [executor.submit(worker) for _ in range(concurrency)]
+    downloads = [download for future in futures for download in future.result()]
+  wall_time = time.perf_counter() - start
+
+  completed = [download for download in downloads if download['status_code'] == 200]
+  latencies = [download['elapsed'] * 1000 for download in completed]
+  received = sum(download['received'] for download in completed)
+  return {
+    'concurrency': concurrency,
+    'requests': len(downloads),
+    'failed': len(downloads) - len(completed),
+    'received': received,
+    'wall_time': wall_time,
+    'throughput': (received * 8) / wall_time / (1024 * 1024),  # aggregate, in Mbps
+    'p50': percentile(latencies, 0.5),
+    'p90': percentile(latencies, 0.9),
+    'p99': percentile(latencies, 0.99),
+    'max': max(latencies, default=0),
+  }
+
+def run_load(image_name, image_url, expected_sha256=None, upload_size=None):
+  """
+  Runs the load mode for one image at every concurrency level and writes a CSV summary.
+
+  :param image_name: The image name.
+  :param image_url: The URL of the image.
+  :param expected_sha256: The expected SHA-256 of the body, or None.
+  :param upload_size: The size of the generated payload to upload, or None to download.
+  """
+  stamp = datetime.now().strftime('%Y.%m.%d.%H.%M.%S')
+  summary_path = os.path.join('results', f'{stamp}_{image_name}_load_summary.csv')
+
+  summaries = []
+  for concurrency in load_levels:
+    print(f'{Fore.YELLOW}-----------------------------------------------------------')
+    print(f'{Fore.BLUE}Fetching image {image_name} with {concurrency} concurrent worker(s), {N} download(s) each')
+    result_file = f'{stamp}_{image_name}_c{concurrency}_results.jsonl'
+    summary = run_load_level(image_url, image_name, result_file, concurrency, expected_sha256, upload_size)
+    write_npz_sidecar(result_file)
+    summaries.append(summary)
+    print(f'{Fore.GREEN}Concurrency {concurrency}: {summary["throughput"]:.2f} Mbps aggregate, '
+          f'latency p50 {summary["p50"]:.2f} / p90 {summary["p90"]:.2f} / p99 {summary["p99"]:.2f} ms, '
+          f'{summary["failed"]} failed')
+
+  with open(summary_path, 'w', newline='') as file:
+    writer = csv.writer(file)
+    writer.writerow(['power_mode', 'connection_mode', 'image', 'concurrency', 'requests', 'failed', 'received_bytes',
+                     'wall_time_ms', 'throughput_mbps', 'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms', 'latency_max_ms'])
+    for summary in summaries:
+      writer.writerow([power_mode_config, connection_mode, image_name, summary['concurrency'], summary['requests'],
+                       summary['failed'], summary['received'], f'{summary["wall_time"] * 1000:.2f}', f'{summary["throughput"]:.2f}',
+                       f'{summary["p50"]:.2f}', f'{summary["p90"]:.2f}', f'{summary["p99"]:.2f}', f'{summary["max"]:.2f}'])
+  print(f'{Fore.GREEN}Load summary saved to {summary_path}')
+
+def raw_tcp_test(direction):
+  """
+  Runs one raw TCP test against the server's source/sink port, printing the throughput of every interval.
+
+  Downloads report empty intervals too, so stalls show up as 0 Mbps. Uploads report what
+  was handed to the socket, and take the total from the server's receive count.
+
+  :param direction: download (the server sends) or upload (the server receives).
+  :return: A dictionary with the transferred bytes, the elapsed time, the time to first
+           byte and the timeline [(seconds since the start, cumulative bytes), ...] of the intervals.
+  """
+  interval = tcp_interval_ms / 1000
+  timeline = []
+  transferred = 0
+  first_byte = None
+  last = (0.0, 0)
+
+  def report(now):
+    nonlocal last
+    seconds, count = now - last[0], transferred - last[1]
+    print(f'{Fore.CYAN}{last[0]:7.2f}-{now:7.2f} s  {count / 1024:10.1f} kB  {count * 8 / seconds / (1024 * 1024):9.2f} Mbps')
+    timeline.append((now, transferred))
+    last = (now, transferred)
+
+  start = time.perf_counter()
+  with socket.create_connection((host_ip_address, tcp_port)) as sock:
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if direction == 'download':
+      sock.sendall(f'SOURCE {tcp_duration}\n'.encode())
+      sock.settimeout(interval)
+      buffer = bytearray(256 * 1024)
+      while True:
+        try:
+          count = sock.recv_into(buffer)
+        except socket.timeout:
+          count = None  # Nothing arrived during a whole interval
+        now = time.perf_counter() - start
+        if count == 0:
+          break
+        if count:
+          first_byte = now if first_byte is None else first_byte
+          transferred += count
+        if now - last[0] >= interval:
+          report(now)
+      elapsed = time.perf_counter() - start
+      if transferred != last[1]:
+        report(elapsed)
+    else:
+      sock.sendall(b'SINK\n')
+      block = memoryview(payload_block(0))
+      send_size = 64 * 1024
+      offset = 0
+      while (now := time.perf_counter() - start) < tcp_duration:
+        sock.sendall(block[offset:offset + send_size])
+        offset = (offset + send_size) % len(block)
+        transferred += send_size
+        if now - last[0] >= interval:
+          report(now)
+      if transferred != last[1]:
+        report(time.perf_counter() - start)
+      sock.shutdown(socket.SHUT_WR)
+      # RECEIVED <bytes> <seconds from the first byte>
+      reply = sock.makefile('rb').readline().split()
+      transferred, elapsed = int(reply[1]), float(reply[2])
+
+  return {
+    'received': transferred,
+    'elapsed': elapsed,
+    'ttfb': first_byte or 0,
+    'timeline': timeline,
+  }
+
+def run_tcp():
+  """
+  Runs the raw TCP test N times and writes a result record and the interval timeline of every test.
+  """
+  stamp = datetime.now().strftime('%Y.%m.%d.%H.%M.%S')
+  name = f'tcp_{tcp_direction}'
+  result_file_path = os.path.join('results', f'{stamp}_{name}_results.jsonl')
+  os.makedirs('results', exist_ok=True)
+
+  for i in range(N):
+    print(f'{Fore.YELLOW}-----------------------------------------------------------')
+    print(f'{Fore.BLUE}{i+1}-Raw TCP {tcp_direction} for {tcp_duration} s')
+    start_time = time.time()
+    formatted_start_time = datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S:%f')
+    test = raw_tcp_test(tcp_direction)
+    throughput = (test['received'] * 8) / test['elapsed'] / (1024 * 1024) if test['elapsed'] else 0  # in Mbps
+    print(f'{Fore.GREEN}{test["received"] / 1024:.1f} kB in {test["elapsed"]:.2f} s: {throughput:.2f} Mbps')
+
+    record = make_record(
+      timestamp=start_time,
+      start_time=formatted_start_time,
+      direction='downlink' if tcp_direction == 'download' else 'uplink',
+      image=name,
+      size_bytes=test['received'],
+      power_mode=power_mode_config,
+      connection_mode='new',
+      http_engine='raw_tcp',
+      transfer_time_ms=test['elapsed'] * 1000,
+      ttfb_ms=test['ttfb'] * 1000,
+      throughput_mbps=throughput,
+    )
+    append_records(result_file_path, [record])
+    with open(os.path.splitext(result_file_path)[0] + '_timeline.jsonl', 'a') as file:
+      file.write(json.dumps({
+        'start_time': formatted_start_time,
+        'image': name,
+        'concurrency': 1,
+        'ttfb_ms': test['ttfb'] * 1000,
+        'points': [[round(t * 1000, 3), size] for t, size in test['timeline']],
+      }) + '\n')
+  write_npz_sidecar(os.path.basename(result_file_path))
+
+def download_targets():
+  """
+  Lists what to transfer: the images, the generated payload sizes of the sweep, or the payloads to upload.
+
+  :return: A list of (name, URL, expected SHA-256 or None, upload size or None to download).
+  """
+  if upload_sizes:
+    upload_url = f'http://{host_ip_address}:{port}/upload?sink={upload_sink}'
+    return [(f'upload_{size}b_seed{gen_seed}', upload_url,
+             payload_sha256(size, gen_seed) if upload_sink == 'sha256' else None, size) for size in upload_sizes]
+
+  if not gen_sweep:
+    manifest = fetch_manifest() if verify_downloads else {}
+    for image_name in images_list:
+      if verify_downloads and image_name not in manifest:
+        print(f'{Fore.RED}{image_name} is not in the server manifest, its content is not checked')
+    # URL of the image on the server
+    return [(image_name, f'http://{host_ip_address}:{port}/{image_name}', manifest.get(image_name, {}).get('sha256'), None)
+            for image_name in images_list]
+
+  min_size, max_size, steps = gen_sweep
+  ratio = max_size / min_size
+  sizes = sorted({round(min_size * ratio ** (i / max(steps - 1, 1))) for i in range(steps)})
+  return [(f'gen_{size}b_seed{gen_seed}', f'http://{host_ip_address}:{port}/gen/{size}?seed={gen_seed}',
+           payload_sha256(size, gen_seed), None) for size in sizes]
 
 if __name__ == "__main__":  
-  for image_name in images_list:  
-    filename = datetime.now().strftime('%Y.%m.%d.%H.%M.%S_results.txt')
+  parser = argparse.ArgumentParser(description="Download images from the HTTP server and measure the throughput")
+  parser.add_argument("-n", type=int, default=N, help=f"Number of downloads per image (default: {N})")
+  parser.add_argument("--host", default=host_ip_address, help=f"Server IP address (default: {host_ip_address})")
+  parser.add_argument("--port", type=int, default=port, help=f"Server port (default: {port})")
+  parser.add_argument("--power_mode", default=power_mode_config, help=f"NINA power mode configuration used during the test (default: {power_mode_config})")
+  parser.add_argument("--connection", choices=["pooled", "new"], default=connection_mode, help=f"Reuse one keep-alive connection (pooled) or open a new connection per download (new) (default: {connection_mode})")
+  parser.add_argument("--images", nargs='+', default=images_list, help="Images to download (default: all test images)")
+  parser.add_argument("--engine", choices=["requests", "http.client"], default=http_engine, help=f"HTTP engine of the downloads: requests, or http.client with a per-phase breakdown (DNS, connect, request, wait, body) (default: {http_engine})")
+  parser.add_argument("--chunk_size", type=int, default=chunk_size, help=f"Bytes read per chunk (default: {chunk_size})")
+  parser.add_argument("--stall_threshold", type=float, default=stall_threshold_ms, help=f"Gap between chunks in ms counted as a stall (default: {stall_threshold_ms})")
+  parser.add_argument("--discard", action="store_true", help="Discard the received images instead of writing them to rec_images")
+  parser.add_argument("--verify", action="store_true", help="Check every download against the SHA-256 in the server's /manifest.json instead of writing it to rec_images")
+  parser.add_argument("--keep", type=int, default=keep_copies, help=f"With --verify, still write the first N copies of each image to rec_images, after the timed transfer (default: {keep_copies})")
+  parser.add_argument("--timeline", action="store_true", help="Write the per-chunk time/bytes series of every download to results/*_timeline.jsonl")
+  parser.add_argument("--segments", type=int, default=segments, help=f"Download each image as this many parallel Range requests (default: {segments})")
+  parser.add_argument("--gen_sweep", type=int, nargs=3, metavar=("MIN", "MAX", "STEPS"), help="Download generated payloads of STEPS sizes from MIN to MAX bytes on a log scale instead of the images")
+  parser.add_argument("--seed", type=int, default=gen_seed, help=f"Seed of the generated payloads (default: {gen_seed})")
+  parser.add_argument("--text", action="store_true", help="Also write the human-readable text results to results/*.txt")
+  parser.add_argument("--npz", action="store_true", help="Also write a NumPy .npz copy of every results file")
+  parser.add_argument("--upload", type=int, nargs='+', metavar="BYTES", help="Upload mode: send generated payloads of these sizes to the server instead of downloading")
+  parser.add_argument("--upload_sink", choices=["discard", "sha256"], default=upload_sink, help=f"What the server does with uploads: discard counts the bytes, sha256 also hashes them to check the content (default: {upload_sink})")
+  parser.add_argument("--chunked", action="store_true", help="Send uploads with Transfer-Encoding: chunked instead of Content-Length")
+  parser.add_argument("--tcp", choices=["download", "upload"], help="Raw TCP mode: measure the link without HTTP against the server's --tcp_port")
+  parser.add_argument("--tcp_port", type=int, default=tcp_port, help=f"Raw TCP port of the server (default: {tcp_port})")
+  parser.add_argument("--duration", type=float, default=tcp_duration, help=f"Seconds per raw TCP test (default: {tcp_duration})")
+  parser.add_argument("--interval", type=float, default=tcp_interval_ms, help=f"Raw TCP throughput report interval in ms (default: {tcp_interval_ms})")
+  parser.add_argument("--load", type=int, nargs='+', metavar="K", help="Load mode: run K concurrent download workers (several values ramp the concurrency)")
+  args = parser.parse_args()
+
+  N = args.n
+  host_ip_address = args.host
+  port = args.port
+  power_mode_config = args.power_mode
+  connection_mode = args.connection
+  images_list = args.images
+  http_engine = args.engine
+  if http_engine == "http.client" and (args.upload or args.segments > 1):
+    parser.error("--engine http.client times single-stream downloads; uploads and --segments use requests")
+  chunk_size = args.chunk_size
+  stall_threshold_ms = args.stall_threshold
+  save_images = not args.discard
+  timeline_enabled = args.timeline
+  verify_downloads = args.verify
+  keep_copies = args.keep
+  load_levels = args.load or load_levels
+  segments = args.segments
+  gen_sweep = args.gen_sweep
+  gen_seed = args.seed
+  text_results = args.text
+  npz_sidecar = args.npz
+  upload_sizes = args.upload or upload_sizes
+  upload_sink = args.upload_sink
+  chunked_upload = args.chunked
+  tcp_direction = args.tcp
+  tcp_port = args.tcp_port
+  tcp_duration = args.duration
+  tcp_interval_ms = args.interval
+
+  if tcp_direction:
+    run_tcp()
+    raise SystemExit
+
+  for image_name, image_url, expected_sha256, upload_size in download_targets():  
+    if load_levels:
+      run_load(image_name, image_url, expected_sha256, upload_size)
+      continue
+
+    filename = datetime.now().strftime('%Y.%m.%d.%H.%M.%S') + f'_{image_name}_results.jsonl'
     print(f'{Fore.YELLOW}-----------------------------------------------------------')
+    # One session per image, so the first download of each image pays the connection setup
+    session = new_session()
     for i in range(N):
-      print(f'{Fore.BLUE}{i+1}-Fetching image: {image_name}')
-      image_url = f'http://{host_ip_address}:{port}/{image_name}'  # URL of the image on the server
-      fetch_image(image_url, image_name, filename)
+      print(f'{Fore.BLUE}{i+1}-{"Fetching" if upload_size is None else "Uploading"} image: {image_name}')
+      keep_path = os.path.join('rec_images', f'{i + 1}_{image_name}') if verify_downloads and i < keep_copies else None
+      fetch_image(image_url, image_name, filename, session, expected_sha256=expected_sha256, upload_size=upload_size,
+                  keep_path=keep_path)
+    if session is not None:
+      session.close()
+    write_npz_sidecar(filename)
     
   print(f'{Fore.YELLOW}-----------------------------------------------------------\n')
\ No newline at end of file
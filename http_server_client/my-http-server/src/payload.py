@@ -0,0 +1,50 @@
+import hashlib
+import random
+from functools import lru_cache
+
+BLOCK_SIZE = 1024 * 1024  # Size of the precomputed pseudo-random block
+
+@lru_cache(maxsize=8)
+def payload_block(seed):
+    """
+    Returns the pseudo-random block for a seed. Generated payloads repeat this block.
+
+    :param seed: The payload seed.
+    :return: BLOCK_SIZE deterministic pseudo-random bytes.
+    """
+    return random.Random(seed).randbytes(BLOCK_SIZE)
+
+def iter_payload(size, seed, start=0, length=None):
+    """
+    Yields the bytes of a generated payload without copying the block.
+
+    Byte i of the payload for a seed is byte i % BLOCK_SIZE of its block.
+
+    :param size: The payload size in bytes.
+    :param seed: The payload seed.
+    :param start: The first byte to yield.
+    :param length: The number of bytes to yield (default: up to the end of the payload).
+    :return: An iterator of memoryview chunks of at most BLOCK_SIZE bytes.
+    """
+    block = memoryview(payload_block(seed))
+    end = size if length is None else min(size, start + length)
+    position = start
+    while position < end:
+        offset = position % BLOCK_SIZE
+        chunk = block[offset:offset + min(BLOCK_SIZE - offset, end - position)]
+        yield chunk
+        position += len(chunk)
+
+@lru_cache(maxsize=256)
+def payload_sha256(size, seed):
+    """
+    Returns the SHA-256 of a generated payload.
+
+    :param size: The payload size in bytes.
+    :param seed: The payload seed.
+    :return: The hex digest.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter_payload(size, seed):
+        digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,126 @@
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Only needed for the array and .npz helpers
+
+# Fixed schema of a result record: field name -> default value.
+# Every record written by the client has exactly these fields, in this order.
+RESULT_FIELDS = {
+    'timestamp': 0.0,  # Start of the transfer, seconds since the epoch
+    'start_time': '',  # Start of the transfer, formatted
+    'request_id': '',  # X-Request-ID sent to the server (segments add -<index>)
+    'direction': 'downlink',
+    'image': '',
+    'size_bytes': 0,
+    'power_mode': '',
+    'connection_mode': '',
+    'concurrency': 1,
+    'segments': 1,
+    'http_engine': 'requests',
+    'transfer_time_ms': 0.0,
+    'ttfb_ms': 0.0,
+    # Phases of the http.client engine (0 with requests): name resolution, TCP connect
+    # (0 on a reused connection), sending the request, waiting for the headers, receiving the body
+    'dns_ms': 0.0,
+    'connect_ms': 0.0,
+    'request_ms': 0.0,
+    'wait_ms': 0.0,
+    'body_ms': 0.0,
+    'stalls': 0,
+    'max_stall_ms': 0.0,
+    'throughput_mbps': 0.0,
+    'body_throughput_mbps': 0.0,  # Body bytes over body_ms (http.client engine)
+    'content_check': 'skipped',
+    # UDP tests (udp_blaster.py)
+    'packets': 0,
+    'lost_packets': 0,
+    'reordered_packets': 0,
+    'jitter_ms': 0.0,  # RFC 3550 interarrival jitter at the end of the test
+}
+
+def make_record(**values):
+    """
+    Builds a result record with every schema field, using the defaults for missing values.
+
+    :param values: The field values.
+    :return: The record as a dictionary.
+    """
+    unknown = values.keys() - RESULT_FIELDS.keys()
+    if unknown:
+        raise ValueError(f"Unknown result fields: {', '.join(sorted(unknown))}")
+    return {name: values.get(name, default) for name, default in RESULT_FIELDS.items()}
+
+def append_records(path, records):
+    """
+    Appends records to a JSON lines file.
+
+    :param path: The .jsonl file.
+    :param records: The records to append.
+    """
+    with open(path, 'a') as file:
+        file.writelines(json.dumps(record) + '\n' for record in records)
+
+def load_records(path):
+    """
+    Loads the records of a JSON lines file, filling fields added to the schema later with their defaults.
+
+    :param path: The .jsonl file.
+    :return: A list of records.
+    """
+    with open(path, 'r') as file:
+        return [{**RESULT_FIELDS, **json.loads(line)} for line in file if line.strip()]
+
+def records_to_arrays(records):
+    """
+    Converts records to one NumPy array per field.
+
+    :param records: The records.
+    :return: A dictionary of field name -> array.
+    """
+    arrays = {}
+    for name, default in RESULT_FIELDS.items():
+        values = [record[name] for record in records]
+        if isinstance(default, str):
+            arrays[name] = np.array(values, dtype=str)
+        else:
+            arrays[name] = np.array(values, dtype=type(default))
+    return arrays
+
+def load_arrays(path):
+    """
+    Loads a results file straight into arrays. A .npz sidecar next to the .jsonl file is used when it is up to date.
+
+    :param path: The .jsonl file.
+    :return: A dictionary of field name -> array.
+    """
+    sidecar = os.path.splitext(path)[0] + '.npz'
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        with np.load(sidecar) as data:
+            if RESULT_FIELDS.keys() <= set(data.files):
+                return {name: data[name] for name in RESULT_FIELDS}
+    return records_to_arrays(load_records(path))
+
+def save_npz(path, records):
+    """
+    Writes the records as a compressed NumPy .npz file (one array per field).
+
+    :param path: The .npz file.
+    :param records: The records.
+    """
+    np.savez_compressed(path, **records_to_arrays(records))
+
+def load_server_timing(path):
+    """
+    Loads the per-request timing log of the server (server.py --timing_log), indexed by request ID.
+
+    A client record joins the server record with the same request_id; the segments of a
+    segmented download are logged as <request_id>-<index>.
+
+    :param path: The timing log file.
+    :return: A dictionary of request ID -> server record.
+    """
+    with open(path, 'r') as file:
+        return {record['request_id']: record for record in map(json.loads, filter(str.strip, file))}
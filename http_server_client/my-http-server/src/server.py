@@ -1,6 +1,26 @@
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+from http.server import SimpleHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+import io
 import os
+import re
+import json
+import mimetypes
+import hashlib
+import mmap
+import time
+import uuid
+import bisect
 import socket
+import asyncio
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from http import HTTPStatus
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs, unquote
+from payload import iter_payload, payload_block
 from colorama import Fore, Style, init
 
 def get_wifi_ip():
@@ -18,17 +38,881 @@ def get_wifi_ip():
 ip_address = get_wifi_ip()
 port = 4043
 
+class CachedMapping:
+    """
+    A memory-mapped file in the image cache, with the number of bodies still reading it.
+    """
+
+    def __init__(self, mapped, size, mtime):
+        self.mapped = mapped
+        self.size = size
+        self.mtime = mtime
+        self.readers = 0
+        self.evicted = False  # Out of the cache; unmapped when the last reader is done
+
+class MappedBody:
+    """
+    Body of a cached image: a zero-copy slice of the mapping. Closing it releases the view,
+    and unmaps the file if it was evicted meanwhile and this was its last reader.
+    """
+
+    def __init__(self, cache, entry, view):
+        self.cache = cache
+        self.entry = entry
+        self.view = view
+
+    def close(self):
+        if self.view is not None:
+            self.cache.release(self.entry, self.view)
+            self.view = None
+
+class ImageCache:
+    """
+    LRU cache of memory-mapped image files, bounded by the total mapped size.
+
+    Bodies are handed out with a reader count taken under the lock, so an evicted or
+    remapped file is only unmapped once no response is still sending from it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # path -> CachedMapping
+        self.lock = threading.Lock()
+
+    def get(self, path, stat, start, length):
+        """
+        Returns a body reading a range of the mapped file, mapping it if needed. Files that
+        changed on disk are mapped again.
+
+        :param path: The file path.
+        :param stat: The os.stat result of the file.
+        :param start: The first byte of the range.
+        :param length: The length of the range.
+        :return: A MappedBody, or None if the file is empty or larger than the cache.
+        """
+        if stat.st_size == 0 or stat.st_size > self.max_bytes:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+                self.entries.move_to_end(path)
+            else:
+                if entry:
+                    self._evict(path)
+                with open(path, 'rb') as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                entry = self.entries[path] = CachedMapping(mapped, stat.st_size, stat.st_mtime)
+                self.size += stat.st_size
+                while self.size > self.max_bytes:
+                    self._evict(next(iter(self.entries)))
+            entry.readers += 1
+            return MappedBody(self, entry, memoryview(entry.mapped)[start:start + length])
+
+    def release(self, entry, view):
+        """
+        Releases the view of a body, unmapping an evicted file once its last reader is done.
+
+        :param entry: The CachedMapping the body reads.
+        :param view: The memoryview of the body.
+        """
+        view.release()
+        with self.lock:
+            entry.readers -= 1
+            if entry.evicted and entry.readers == 0:
+                entry.mapped.close()
+
+    def _evict(self, path):
+        entry = self.entries.pop(path)
+        self.size -= entry.size
+        entry.evicted = True
+        if entry.readers == 0:
+            entry.mapped.close()
+
+image_cache = None  # ImageCache when the mmap cache is enabled
+
+class ImageManifest:
+    """
+    SHA-256 and size of every file in the images directory, for the client's verify mode.
+
+    Hashes are computed on the first request and again only for files that changed on disk.
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.entries = {}  # name -> (size, mtime, sha256)
+        self.lock = threading.Lock()
+
+    def build(self):
+        """
+        :return: A dictionary of file name -> {"size": bytes, "sha256": hex digest}.
+        """
+        manifest = {}
+        with self.lock:
+            for entry in sorted(os.scandir(self.directory), key=lambda entry: entry.name):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                cached = self.entries.get(entry.name)
+                if not cached or cached[:2] != (stat.st_size, stat.st_mtime):
+                    digest = hashlib.sha256()
+                    with open(entry.path, 'rb') as file:
+                        while chunk := file.read(1024 * 1024):
+                            digest.update(chunk)
+                    cached = self.entries[entry.name] = (stat.st_size, stat.st_mtime, digest.hexdigest())
+                manifest[entry.name] = {'size': cached[0], 'sha256': cached[2]}
+            # Forget files that were removed
+            for name in self.entries.keys() - manifest.keys():
+                del self.entries[name]
+        return manifest
+
+image_manifest = ImageManifest()
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, rendered in the Prometheus text format.
+    """
+
+    # Upper bounds of the buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # Last bucket: above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, name):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum:.6f}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+class RequestMetrics:
+    """
+    Request counters and latency histograms of the server, shared by all handler threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (method, status) -> count
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.in_flight = 0
+        self.headers_latency = Histogram()  # Request received -> headers handed to the kernel
+        self.duration = Histogram()  # Request received -> last body byte handed to the kernel
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, method, status, bytes_sent, bytes_received, headers_seconds, total_seconds):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[(method, status)] += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            if headers_seconds is not None:
+                self.headers_latency.observe(headers_seconds)
+            self.duration.observe(total_seconds)
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# TYPE http_requests_total counter']
+            for (method, status), count in sorted(self.requests.items(), key=str):
+                lines.append(f'http_requests_total{{method="{method}",status="{status}"}} {count}')
+            lines += ['# TYPE http_response_bytes_total counter', f'http_response_bytes_total {self.bytes_sent}',
+                      '# TYPE http_request_bytes_total counter', f'http_request_bytes_total {self.bytes_received}',
+                      '# TYPE http_requests_in_flight gauge', f'http_requests_in_flight {self.in_flight}',
+                      '# TYPE http_response_headers_seconds histogram']
+            lines += self.headers_latency.render('http_response_headers_seconds')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            lines += self.duration.render('http_request_duration_seconds')
+        return '\n'.join(lines) + '\n'
+
+metrics = RequestMetrics()
+UPLOAD_BUFFER_SIZE = 256 * 1024  # Bytes read per chunk of an upload body
+timing_log = None  # Open JSON lines file of the per-request timing records, when enabled
+timing_log_lock = threading.Lock()
+
+def log_timing(record):
+    """
+    Appends a per-request timing record to the timing log, if enabled.
+
+    :param record: The timing record.
+    """
+    if timing_log:
+        with timing_log_lock:
+            timing_log.write(json.dumps(record) + '\n')
+
+class GeneratedPayload:
+    """
+    Body of a /gen/<bytes>?seed=N response, streamed from the precomputed block.
+    """
+
+    def __init__(self, size, seed, start, length):
+        self.size = size
+        self.seed = seed
+        self.start = start
+        self.length = length
+
+    def __iter__(self):
+        return iter_payload(self.size, self.seed, self.start, self.length)
+
+    def close(self):
+        pass
+
+def not_modified(if_modified_since, if_none_match, mtime):
+    """
+    Checks a conditional GET the way SimpleHTTPRequestHandler does.
+
+    :param if_modified_since: The If-Modified-Since header value, or None.
+    :param if_none_match: The If-None-Match header value, or None. If-Modified-Since is ignored when it is present.
+    :param mtime: The modification time of the file.
+    :return: True if the file was not modified since the given date, for a 304 response.
+    """
+    if if_modified_since is None or if_none_match is not None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return False  # Ignore ill-formed values
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)  # Obsolete format without a time zone
+    if since.tzinfo is not timezone.utc:
+        return False
+    # If-Modified-Since has no microseconds
+    return datetime.fromtimestamp(mtime, timezone.utc).replace(microsecond=0) <= since
+
+def parse_range(header, size):
+    """
+    Parses a single-range "Range: bytes=..." header.
+
+    :param header: The Range header value.
+    :param size: The file size.
+    :return: (start, length), None to ignore the header, or False if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)
+    if not match or match.group(1) == match.group(2) == '':
+        return None  # Multiple or malformed ranges: send the whole file
+    if match.group(1) == '':
+        # Suffix range: the last N bytes
+        length = min(int(match.group(2)), size)
+        return (size - length, length) if length > 0 else False
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end - start + 1
+
 class ImageRequestHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests (files are sent with Content-Length)
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; don't let Nagle hold back small bodies
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         client_ip, client_port = self.client_address
         print(f'{Fore.BLUE}Received request from {client_ip}:{client_port}')
-        if self.path.startswith('/images/'):
-            self.path = self.path[1:]  # Remove leading '/'
-        return super().do_GET()
+        with self.request_timing():
+            if self.path == '/metrics':
+                return self.send_metrics()
+            if self.path == '/manifest.json':
+                return self.send_manifest()
+            self.path = self.rewrite_path(self.path)
+            return super().do_GET()
+
+    def do_HEAD(self):
+        with self.request_timing():
+            self.path = self.rewrite_path(self.path)
+            return super().do_HEAD()
+
+    def do_PUT(self):
+        client_ip, client_port = self.client_address
+        print(f'{Fore.BLUE}Received upload from {client_ip}:{client_port}')
+        with self.request_timing():
+            return self.receive_upload()
+
+    do_POST = do_PUT
+
+    @staticmethod
+    def rewrite_path(path):
+        # The server runs in the images directory, so /images/<name> is served as /<name>
+        if path.startswith('/images/'):
+            return path[len('/images'):]
+        return path
+
+    @contextmanager
+    def request_timing(self):
+        """
+        Times the request and records it in the metrics and the timing log.
+
+        The request ID comes from the X-Request-ID header (a new one is generated
+        without it) and is echoed in the response, so clients can join their
+        measurements with the server records.
+        """
+        self.request_id = self.headers.get('X-Request-ID') or uuid.uuid4().hex
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.headers_sent_ns = None
+        path = self.path
+        timestamp = time.time()
+        start = time.perf_counter_ns()
+        metrics.begin()
+        complete = False
+        try:
+            yield
+            complete = True
+        finally:
+            end = time.perf_counter_ns()
+            headers_ns = self.headers_sent_ns - start if self.headers_sent_ns else None
+            metrics.end(self.command, self.status, self.bytes_sent, self.bytes_received,
+                        headers_ns / 1e9 if headers_ns is not None else None, (end - start) / 1e9)
+            log_timing({
+                'request_id': self.request_id,
+                'timestamp': timestamp,
+                'client': self.client_address[0],
+                'method': self.command,
+                'path': path,
+                'status': self.status,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'headers_ms': headers_ns / 1e6 if headers_ns is not None else None,
+                'body_ms': (end - self.headers_sent_ns) / 1e6 if self.headers_sent_ns else None,
+                'total_ms': (end - start) / 1e6,
+                'complete': complete,
+            })
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.status = code
+        if getattr(self, 'request_id', None):
+            self.send_header('X-Request-ID', self.request_id)
+
+    def flush_headers(self):
+        super().flush_headers()
+        if getattr(self, 'headers_sent_ns', 0) is None:
+            self.headers_sent_ns = time.perf_counter_ns()  # First response byte handed to the kernel
+
+    def receive_upload(self):
+        # /upload?sink=discard|sha256: consume the body chunk by chunk, never holding it in memory
+        url = urlsplit(self.path)
+        sink = parse_qs(url.query).get('sink', ['discard'])[0]
+        # Until the body is consumed, the next request on the connection cannot be found
+        close_after = self.close_connection
+        self.close_connection = True
+        if url.path != '/upload':
+            self.send_error(404, "Uploads go to /upload")
+            return
+        if sink not in ('discard', 'sha256'):
+            self.send_error(400, "Expected /upload?sink=discard or /upload?sink=sha256")
+            return
+        chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        if not chunked and 'Content-Length' not in self.headers:
+            self.send_error(411, "Send Content-Length or a chunked body")
+            return
+
+        digest = hashlib.sha256() if sink == 'sha256' else None
+        start = time.perf_counter_ns()
+        try:
+            body = self.iter_chunked_body() if chunked else self.iter_body(int(self.headers['Content-Length']))
+            for chunk in body:
+                self.bytes_received += len(chunk)
+                if digest:
+                    digest.update(chunk)
+        except ValueError:
+            self.send_error(400, "Malformed request body")
+            return
+        elapsed = time.perf_counter_ns() - start
+        self.close_connection = close_after
+
+        reply = json.dumps({
+            'received': self.bytes_received,
+            'sha256': digest.hexdigest() if digest else None,
+            'body_ms': elapsed / 1e6,
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+        self.bytes_sent = len(reply)
+
+    def iter_body(self, length, buffer=None):
+        """
+        Yields a request body of known length, reusing one buffer.
+
+        :param length: The Content-Length.
+        :param buffer: The memoryview to read into (default: a new one of UPLOAD_BUFFER_SIZE bytes).
+        :return: An iterator of memoryview chunks, only valid until the next one.
+        """
+        if length < 0:
+            raise ValueError("Negative Content-Length")
+        if buffer is None:
+            buffer = memoryview(bytearray(UPLOAD_BUFFER_SIZE))
+        while length > 0:
+            count = self.rfile.readinto(buffer[:min(length, UPLOAD_BUFFER_SIZE)])
+            if not count:
+                raise ConnectionResetError("Connection closed in the request body")
+            length -= count
+            yield buffer[:count]
+
+    def iter_chunked_body(self):
+        """
+        Yields a request body sent with Transfer-Encoding: chunked.
+
+        :return: An iterator of memoryview chunks, only valid until the next one.
+        """
+        buffer = memoryview(bytearray(UPLOAD_BUFFER_SIZE))
+        while True:
+            size_line = self.rfile.readline(65537)
+            if not size_line:
+                raise ConnectionResetError("Connection closed in the request body")
+            size = int(size_line.split(b';', 1)[0], 16)  # Chunk extensions are ignored
+            if size == 0:
+                break
+            yield from self.iter_body(size, buffer)
+            if self.rfile.readline(3) not in (b'\r\n', b'\n'):
+                raise ValueError("Missing CRLF after a chunk")
+        # Skip the trailer fields up to the empty line
+        while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+            pass
+
+    def send_manifest(self):
+        body = json.dumps(image_manifest.build(), indent=1).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+        self.bytes_sent = len(body)
+
+    def send_metrics(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+        self.bytes_sent = len(body)
+
+    def send_head(self):
+        if self.path.startswith('/gen/'):
+            return self.send_generated_head()
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()  # Directory listings, redirects and 404
+
+        stat = os.stat(path)
+        if not_modified(self.headers.get('If-Modified-Since'), self.headers.get('If-None-Match'), stat.st_mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return None
+        size = stat.st_size
+        body_range = (0, size)
+        status = 200
+        if 'Range' in self.headers:
+            requested = parse_range(self.headers['Range'], size)
+            if requested is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            if requested:
+                body_range = requested
+                status = 206
+
+        body = image_cache.get(path, stat, *body_range) if image_cache else None
+        if body is None:
+            try:
+                body = open(path, 'rb')
+            except OSError:
+                self.send_error(404, "File not found")
+                return None
+        self.body_range = body_range
+
+        self.send_response(status)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(body_range[1]))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+        if status == 206:
+            start, length = body_range
+            self.send_header('Content-Range', f'bytes {start}-{start + length - 1}/{size}')
+        self.end_headers()
+        return body
+
+    def send_generated_head(self):
+        # /gen/<bytes>?seed=N: deterministic pseudo-random bytes, never read from disk
+        url = urlsplit(self.path)
+        try:
+            size = int(url.path[len('/gen/'):])
+            seed = int(parse_qs(url.query).get('seed', ['0'])[0])
+            if size < 0:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, "Expected /gen/<bytes>?seed=<integer>")
+            return None
+
+        body_range = (0, size)
+        status = 200
+        if 'Range' in self.headers and size > 0:
+            requested = parse_range(self.headers['Range'], size)
+            if requested is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            if requested:
+                body_range = requested
+                status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(body_range[1]))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('X-Payload-Seed', str(seed))
+        if status == 206:
+            start, length = body_range
+            self.send_header('Content-Range', f'bytes {start}-{start + length - 1}/{size}')
+        self.end_headers()
+        return GeneratedPayload(size, seed, *body_range)
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, GeneratedPayload):
+            for chunk in source:
+                outputfile.write(chunk)
+                self.bytes_sent += len(chunk)
+            return
+        if isinstance(source, MappedBody):
+            # Cached image: write the mapped pages straight to the socket
+            outputfile.write(source.view)
+            self.bytes_sent = source.view.nbytes
+            return
+        if isinstance(source, io.BytesIO):
+            self.bytes_sent = source.getbuffer().nbytes
+            return super().copyfile(source, outputfile)  # Directory listing
+        # Hand the file to the kernel with sendfile(), so the body goes from the
+        # page cache to the socket without passing through Python buffers
+        outputfile.flush()
+        start, length = getattr(self, 'body_range', (0, None))
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(source.fileno(), start, length or 0, os.POSIX_FADV_SEQUENTIAL)
+        self.bytes_sent = self.connection.sendfile(source, start, length)
+
+class RawTcpHandler(socketserver.BaseRequestHandler):
+    """
+    iperf-style raw TCP test, without HTTP. The client sends one command line:
+
+    SOURCE <seconds>: the server streams data for that long, then closes the connection.
+    SINK: the server discards data until the client shuts down its side, then answers
+          "RECEIVED <bytes> <seconds>" (from the first byte to the end of the stream).
+    """
+
+    SEND_SIZE = 64 * 1024  # Bytes per sendall, so the duration is not overshot on slow links
+
+    def handle(self):
+        client_ip, client_port = self.client_address
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        command = self.read_command().split()
+        print(f'{Fore.BLUE}Raw TCP {b" ".join(command).decode(errors="replace")} from {client_ip}:{client_port}')
+        if len(command) == 2 and command[0] == b'SOURCE' and command[1].replace(b'.', b'', 1).isdigit():
+            self.source(float(command[1]))
+        elif command == [b'SINK']:
+            self.sink()
+
+    def read_command(self):
+        # Byte by byte, so none of the data following the command is consumed
+        line = bytearray()
+        while len(line) < 64 and not line.endswith(b'\n'):
+            byte = self.request.recv(1)
+            if not byte:
+                break
+            line += byte
+        return bytes(line)
+
+    def source(self, duration):
+        block = memoryview(payload_block(0))
+        deadline = time.perf_counter() + duration
+        offset = 0
+        try:
+            while time.perf_counter() < deadline:
+                self.request.sendall(block[offset:offset + self.SEND_SIZE])
+                offset = (offset + self.SEND_SIZE) % len(block)
+            self.request.shutdown(socket.SHUT_WR)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client stopped early
+
+    def sink(self):
+        buffer = bytearray(UPLOAD_BUFFER_SIZE)
+        received = 0
+        first = None
+        while count := self.request.recv_into(buffer):
+            if first is None:
+                first = time.perf_counter()
+            received += count
+        elapsed = time.perf_counter() - first if first else 0
+        self.request.sendall(f'RECEIVED {received} {elapsed:.6f}\n'.encode())
+
+class RawTcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class AsyncResponse:
+    """
+    Response side of one request of the asyncio engine, with the timing and byte counts of ImageRequestHandler.
+    """
+
+    def __init__(self, writer, request_id, keep_alive):
+        self.writer = writer
+        self.request_id = request_id
+        self.keep_alive = keep_alive
+        self.status = None
+        self.bytes_sent = 0
+        self.headers_sent_ns = None
+
+    async def start(self, status, headers):
+        """
+        Sends the status line and the headers, waiting until the write buffer is below its limit.
+
+        :param status: The status code.
+        :param headers: A list of (name, value) headers.
+        """
+        self.status = status
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}',
+                 f'Server: {ImageRequestHandler.server_version}',
+                 f'Date: {formatdate(usegmt=True)}',
+                 f'X-Request-ID: {self.request_id}']
+        lines += [f'{name}: {value}' for name, value in headers]
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self.writer.drain()
+        self.headers_sent_ns = time.perf_counter_ns()
+
+    async def write(self, data):
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+        await self.writer.drain()
+
+    async def send_body(self, content_type, body, head_only=False):
+        await self.start(200, [('Content-Type', content_type), ('Content-Length', str(len(body))),
+                               ('Cache-Control', 'no-store')])
+        if not head_only:
+            await self.write(body)
+
+    async def send_error(self, status, message):
+        body = f'{status} {message}\n'.encode()
+        await self.start(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        await self.write(body)
+
+class AsyncImageServer:
+    """
+    asyncio engine: one coroutine per connection instead of one thread, so a single process
+    keeps hundreds of slow clients busy.
+
+    It serves the same paths as ImageRequestHandler (images with Range, /gen/, /manifest.json
+    and /metrics) with keep-alive and sendfile bodies. Every connection holds at most
+    HEADER_LIMIT bytes of request headers and WRITE_BUFFER bytes of pending response.
+    Uploads and directory listings are left to the threaded engine.
+    Takes the same arguments as the socketserver engines.
+    """
+
+    HEADER_LIMIT = 64 * 1024  # Request line plus headers
+    WRITE_BUFFER = 256 * 1024  # High-water mark of the write buffer
+    SEND_SIZE = 64 * 1024  # Bytes per write of generated payloads
+
+    def __init__(self, server_address, handler_class):
+        self.server_address = server_address
+        self.handler_class = handler_class
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle_connection, host or None, port,
+                                            limit=self.HEADER_LIMIT, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        client_ip, client_port = writer.get_extra_info('peername')[:2]
+        print(f'{Fore.BLUE}Connection from {client_ip}:{client_port}')
+        writer.transport.set_write_buffer_limits(high=self.WRITE_BUFFER)
+        try:
+            while await self.handle_request(reader, writer, client_ip):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_request(self, reader, writer, client_ip):
+        """
+        Reads and answers one request.
+
+        :return: True to keep the connection open for the next request.
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return False  # Closed between requests
+        except asyncio.LimitOverrunError:
+            await AsyncResponse(writer, uuid.uuid4().hex, False).send_error(431, "Request headers too large")
+            return False
+
+        lines = head.decode('latin-1').split('\r\n')
+        request_line = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+            await AsyncResponse(writer, uuid.uuid4().hex, False).send_error(400, "Bad request line")
+            return False
+        method, target, version = request_line
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+            keep_alive = False  # Request bodies are not read, so the next request cannot be found
+
+        response = AsyncResponse(writer, headers.get('x-request-id') or uuid.uuid4().hex, keep_alive)
+        timestamp = time.time()
+        start = time.perf_counter_ns()
+        metrics.begin()
+        complete = False
+        try:
+            await self.respond(method, target, headers, response)
+            complete = True
+        finally:
+            end = time.perf_counter_ns()
+            headers_ns = response.headers_sent_ns - start if response.headers_sent_ns else None
+            metrics.end(method, response.status, response.bytes_sent, 0,
+                        headers_ns / 1e9 if headers_ns is not None else None, (end - start) / 1e9)
+            log_timing({
+                'request_id': response.request_id,
+                'timestamp': timestamp,
+                'client': client_ip,
+                'method': method,
+                'path': target,
+                'status': response.status,
+                'bytes_sent': response.bytes_sent,
+                'bytes_received': 0,
+                'headers_ms': headers_ns / 1e6 if headers_ns is not None else None,
+                'body_ms': (end - response.headers_sent_ns) / 1e6 if response.headers_sent_ns else None,
+                'total_ms': (end - start) / 1e6,
+                'complete': complete,
+            })
+        return response.keep_alive
+
+    async def respond(self, method, target, headers, response):
+        if method not in ('GET', 'HEAD'):
+            response.keep_alive = False
+            await response.send_error(501, f"Unsupported method ({method})")
+            return
+        head_only = method == 'HEAD'
+        url = urlsplit(target)
+        path = self.handler_class.rewrite_path(unquote(url.path))
+
+        if path == '/metrics':
+            await response.send_body('text/plain; version=0.0.4', metrics.render().encode(), head_only)
+            return
+        if path == '/manifest.json':
+            manifest = await asyncio.to_thread(image_manifest.build)  # Hashing new files blocks
+            await response.send_body('application/json', json.dumps(manifest, indent=1).encode(), head_only)
+            return
+
+        if path.startswith('/gen/'):
+            try:
+                size = int(path[len('/gen/'):])
+                seed = int(parse_qs(url.query).get('seed', ['0'])[0])
+                if size < 0:
+                    raise ValueError
+            except ValueError:
+                await response.send_error(400, "Expected /gen/<bytes>?seed=<integer>")
+                return
+            content_type, extra_headers = 'application/octet-stream', [('X-Payload-Seed', str(seed))]
+        else:
+            # Same mapping as SimpleHTTPRequestHandler.translate_path, from the images directory
+            words = [word for word in path.split('/') if word and word not in ('.', '..')]
+            file_path = os.path.join(os.getcwd(), *words)
+            if not os.path.isfile(file_path):
+                await response.send_error(404, "File not found")
+                return
+            stat = os.stat(file_path)
+            if not_modified(headers.get('if-modified-since'), headers.get('if-none-match'), stat.st_mtime):
+                await response.start(304, [])
+                return
+            size = stat.st_size
+            content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+            extra_headers = [('Last-Modified', formatdate(stat.st_mtime, usegmt=True))]
+
+        start, length = 0, size
+        status = 200
+        if 'range' in headers and size > 0:
+            requested = parse_range(headers['range'], size)
+            if requested is False:
+                await response.start(416, [('Content-Range', f'bytes */{size}'), ('Content-Length', '0')])
+                return
+            if requested:
+                (start, length), status = requested, 206
+                extra_headers.append(('Content-Range', f'bytes {start}-{start + length - 1}/{size}'))
+
+        response_headers = [('Content-Type', content_type), ('Content-Length', str(length)),
+                            ('Accept-Ranges', 'bytes')] + extra_headers
+        if path.startswith('/gen/'):
+            await response.start(status, response_headers)
+            if not head_only:
+                for chunk in iter_payload(size, seed, start, length):
+                    for offset in range(0, len(chunk), self.SEND_SIZE):
+                        await response.write(chunk[offset:offset + self.SEND_SIZE])
+            return
+
+        with open(file_path, 'rb') as file:
+            await response.start(status, response_headers)
+            if not head_only and length:
+                # The kernel copies the file to the socket; falls back to read/send where sendfile is missing
+                response.bytes_sent += await asyncio.get_running_loop().sendfile(
+                    response.writer.transport, file, start, length)
+
+server_engines = {
+    'threaded': ThreadingHTTPServer,  # One thread per connection
+    'single': HTTPServer,  # One client at a time
+    'asyncio': AsyncImageServer,  # One coroutine per connection
+}
 
 init(autoreset=True)
 
-def run(server_class=HTTPServer, handler_class=ImageRequestHandler, port=4043):
+def run(server_class=ThreadingHTTPServer, handler_class=ImageRequestHandler, port=4043, tcp_port=None):
+    if tcp_port:
+        tcp_server = RawTcpServer(('', tcp_port), RawTcpHandler)
+        threading.Thread(target=tcp_server.serve_forever, daemon=True).start()
+        print(f'{Fore.GREEN}Raw TCP source/sink on port {tcp_port}')
+
     script_dir = os.path.dirname(__file__)  # Get the directory of the script
     images_dir = os.path.join(script_dir, '..', 'images')  # Construct the full path to the images directory
     os.chdir(images_dir)  # Change directory to images folder
@@ -43,4 +927,18 @@ def run(server_class=HTTPServer, handler_class=ImageRequestHandler, port=4043):
     httpd.serve_forever()
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="HTTP server for the image download test")
+    parser.add_argument("--port", type=int, default=port, help=f"Server port (default: {port})")
+    parser.add_argument("--engine", choices=server_engines.keys(), default='threaded', help="threaded: one thread per connection with sendfile bodies, single: one client at a time, asyncio: one coroutine per connection, for many concurrent clients (default: threaded)")
+    parser.add_argument("--cache_mb", type=int, default=0, help="Serve images from an LRU cache of memory-mapped files of this many MB (default: 0, disabled)")
+    parser.add_argument("--tcp_port", type=int, help="Also open this port for raw TCP source/sink tests (client.py --tcp)")
+    parser.add_argument("--timing_log", help="Append a JSON line with the timing of every request to this file")
+    args = parser.parse_args()
+
+    if args.cache_mb > 0:
+        image_cache = ImageCache(args.cache_mb * 1024 * 1024)
+    if args.timing_log:
+        # Opened before run() changes to the images directory; line buffered so records survive a kill
+        timing_log = open(args.timing_log, 'a', buffering=1)
+
+    run(server_class=server_engines[args.engine], port=args.port, tcp_port=args.tcp_port)
\ No newline at end of file
@@ -1,83 +1,408 @@
-import os
-import re
-import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import norm
-
-# Define the directory to search for .txt files
-results_dir = 'results'
-images_dir = 'graphs'
-
-# Create the images directory if it doesn't exist
-if not os.path.exists(images_dir):
-    os.makedirs(images_dir)
-
-# Get all .txt files in the results directory
-txt_files = [f for f in os.listdir(results_dir) if f.endswith('.txt')]
-
-# Open a file to save the statistical information
-with open('statistical_analysis_results.txt', 'w') as result_file:
-    for filename in txt_files:
-        # Extract date from the filename
-        date_str = filename.split('_')[0]
-
-        # Step 1: Read the text file and extract transfer times, image name, and NINA Power mode configuration
-        transfer_times = []
-        image_name = None
-        nina_power_mode = None
-        with open(os.path.join(results_dir, filename), 'r') as file:
-            for line in file:
-                if not image_name:
-                    image_match = re.search(r'Download image (.+)', line)
-                    if image_match:
-                        image_name = image_match.group(1)
-                if not nina_power_mode:
-                    nina_match = re.search(r'NINA Power mode configuration: (.+)', line)
-                    if nina_match:
-                        nina_power_mode = nina_match.group(1)
-                match = re.search(r'Transfer time: (\d+\.\d+) milliseconds', line)
-                if match:
-                    transfer_times.append(float(match.group(1)))
-
-        # Step 2: Calculate statistical measures
-        mean_transfer_time = np.mean(transfer_times)
-        median_transfer_time = np.median(transfer_times)
-        std_dev_transfer_time = np.std(transfer_times)
-        variance_transfer_time = np.var(transfer_times)
-
-        # Write the statistical information to the result file
-        result_file.write(f"Processing file: {filename}\n")
-        result_file.write(f"Image file: {image_name}\n")
-        result_file.write(f"NINA Power mode configuration: {nina_power_mode}\n")
-        result_file.write(f"Mean: {mean_transfer_time:.2f} ms\n")
-        result_file.write(f"Median: {median_transfer_time:.2f} ms\n")
-        result_file.write(f"Standard Deviation: {std_dev_transfer_time:.2f} ms\n")
-        result_file.write(f"Variance: {variance_transfer_time:.2f} ms\n\n")
-
-        # Step 3: Plot the normal distribution
-        plt.figure(figsize=(10, 6))
-        plt.hist(transfer_times, bins=30, density=True, alpha=0.6, color='g', label='Transfer Time Histogram')
-
-        # Plot the normal distribution curve
-        xmin, xmax = plt.xlim()
-        x = np.linspace(xmin, xmax, 100)
-        p = norm.pdf(x, mean_transfer_time, std_dev_transfer_time)
-        plt.plot(x, p, 'k', linewidth=2, label='Normal Distribution')
-
-        # Add legend
-        legend = plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0., fontsize=12, frameon=True, fancybox=True, framealpha=0.5)
-
-        # Add lateral text block with mean and std dev information
-        textstr = f"Mean: {mean_transfer_time:.2f} ms\nStd Dev: {std_dev_transfer_time:.2f} ms"
-        plt.gcf().text(0.735, 0.7, textstr, fontsize=12, bbox=dict(facecolor='white', edgecolor='lightgray', boxstyle='round,pad=0.2', alpha=0.5), ha='left', va='center')
-
-        plt.subplots_adjust(right=0.7)  # Adjust the subplot to add padding on the right
-
-        plt.title(f"Transfer time results for {image_name}\nNINA-Power mode: {nina_power_mode}", fontdict={'fontsize': 14, 'fontweight': 'bold'})
-        plt.xlabel('Transfer Time (ms)')
-        plt.ylabel('Density')
-
-        # Save the plot as an image file with date and image name
-        output_filename = os.path.join(images_dir, f'{date_str}_{image_name}_results.png')
-        plt.savefig(output_filename)
-        plt.close()
\ No newline at end of file
+import os
+import re
+import csv
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Render to files only, also in worker processes
+import matplotlib.pyplot as plt
+from scipy.stats import norm
+from result_records import RESULT_FIELDS, load_arrays
+
+# Define the directory to search for results files
+results_dir = 'results'
+images_dir = 'graphs'
+
+# Per-file summaries of earlier runs, keyed by results file path and mtime
+cache_file = 'statistical_analysis_cache.json'
+
+# Cross-run comparison outputs
+comparison_file = 'comparison_results.csv'
+comparison_graph = os.path.join(images_dir, 'comparison.png')
+PERCENTILES = (50, 90, 99)
+# Fields of the comparison group key: runs only share a group when they were measured the same way
+GROUP_FIELDS = ('power_mode', 'direction', 'connection_mode', 'concurrency', 'segments', 'http_engine', 'size_bytes')
+# Raw TCP (client.py --tcp) and UDP (udp_blaster.py) tests share the results directory, but
+# their size_bytes is the amount of data moved, not an image size, so they are left out
+NON_HTTP_ENGINES = ('raw_tcp', 'udp')
+BOOTSTRAP_CHUNK_ELEMENTS = 1 << 22  # Resampled values held at once (4M, 32 MB per array)
+
+def http_rows(arrays):
+    """
+    :param arrays: A dictionary of field name -> array.
+    :return: The same arrays without the rows of raw TCP and UDP tests.
+    """
+    keep = ~np.isin(arrays['http_engine'], NON_HTTP_ENGINES)
+    return {name: values[keep] for name, values in arrays.items()}
+
+def load_run(path):
+    """
+    Loads the transfer times, image name and NINA power mode of one results file.
+
+    Structured .jsonl results are loaded straight into arrays, without raw TCP and UDP
+    tests. Text results from older runs are parsed line by line.
+
+    :param path: The results file.
+    :return: (transfer times in ms, image name, NINA power mode configuration)
+    """
+    if path.endswith('.jsonl'):
+        arrays = http_rows(load_arrays(path))
+        if len(arrays['image']) == 0:
+            return np.array([]), None, None
+        return arrays['transfer_time_ms'], str(arrays['image'][0]), str(arrays['power_mode'][0])
+
+    transfer_times = []
+    image_name = None
+    nina_power_mode = None
+    with open(path, 'r') as file:
+        for line in file:
+            if not image_name:
+                image_match = re.search(r'Download image (.+)', line)
+                if image_match:
+                    image_name = image_match.group(1)
+            if not nina_power_mode:
+                nina_match = re.search(r'NINA Power mode configuration: (.+)', line)
+                if nina_match:
+                    nina_power_mode = nina_match.group(1)
+            match = re.search(r'Transfer time: (\d+\.\d+) milliseconds', line)
+            if match:
+                transfer_times.append(float(match.group(1)))
+    return np.array(transfer_times), image_name, nina_power_mode
+
+def list_result_files():
+    """
+    Lists the results files: structured runs, and text results of runs without a structured copy.
+
+    :return: The sorted file names.
+    """
+    result_files = [f for f in os.listdir(results_dir) if f.endswith('_results.jsonl')]
+    structured_runs = {os.path.splitext(f)[0] for f in result_files}
+    txt_files = [f for f in os.listdir(results_dir)
+                 if f.endswith('.txt') and os.path.splitext(f)[0] not in structured_runs]
+    return sorted(result_files + txt_files)
+
+def plot_run(transfer_times, summary, output_filename):
+    """
+    Plots the transfer time histogram of a run with its normal distribution.
+
+    :param transfer_times: The transfer times in ms.
+    :param summary: The summary of the run.
+    :param output_filename: The image file to write.
+    """
+    image_name = summary['image']
+    nina_power_mode = summary['power_mode']
+    mean_transfer_time = summary['mean']
+    std_dev_transfer_time = summary['std']
+
+    plt.figure(figsize=(10, 6))
+    plt.hist(transfer_times, bins=30, density=True, alpha=0.6, color='g', label='Transfer Time Histogram')
+
+    # Plot the normal distribution curve
+    xmin, xmax = plt.xlim()
+    x = np.linspace(xmin, xmax, 100)
+    p = norm.pdf(x, mean_transfer_time, std_dev_transfer_time)
+    plt.plot(x, p, 'k', linewidth=2, label='Normal Distribution')
+
+    # Add legend
+    legend = plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0., fontsize=12, frameon=True, fancybox=True, framealpha=0.5)
+
+    # Add lateral text block with mean and std dev information
+    textstr = f"Mean: {mean_transfer_time:.2f} ms\nStd Dev: {std_dev_transfer_time:.2f} ms"
+    plt.gcf().text(0.735, 0.7, textstr, fontsize=12, bbox=dict(facecolor='white', edgecolor='lightgray', boxstyle='round,pad=0.2', alpha=0.5), ha='left', va='center')
+
+    plt.subplots_adjust(right=0.7)  # Adjust the subplot to add padding on the right
+
+    plt.title(f"Transfer time results for {image_name}\nNINA-Power mode: {nina_power_mode}", fontdict={'fontsize': 14, 'fontweight': 'bold'})
+    plt.xlabel('Transfer Time (ms)')
+    plt.ylabel('Density')
+
+    plt.savefig(output_filename)
+    plt.close()
+
+def graph_path(filename):
+    """
+    :param filename: The results file name.
+    :return: The plot of the run, named after the results file so every run gets its own.
+    """
+    return os.path.join(images_dir, os.path.splitext(filename)[0] + '.png')
+
+def analyze_file(filename):
+    """
+    Computes the statistics of one results file and renders its plot. Runs in a worker process.
+
+    :param filename: The results file name.
+    :return: The summary of the run, or None if it has no transfers.
+    """
+    # Step 1: Load the transfer times, image name, and NINA Power mode configuration
+    transfer_times, image_name, nina_power_mode = load_run(os.path.join(results_dir, filename))
+    if len(transfer_times) == 0:
+        return None
+
+    # Step 2: Calculate statistical measures
+    summary = {
+        'filename': filename,
+        'image': image_name,
+        'power_mode': nina_power_mode,
+        'mean': float(np.mean(transfer_times)),
+        'median': float(np.median(transfer_times)),
+        'std': float(np.std(transfer_times)),
+        'var': float(np.var(transfer_times)),
+        'graph': graph_path(filename),
+    }
+
+    # Step 3: Plot the normal distribution
+    plot_run(transfer_times, summary, summary['graph'])
+    return summary
+
+def load_cache():
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as file:
+            return json.load(file)
+    return {}
+
+def analyze(workers=None, force=False):
+    """
+    Analyzes new or changed results files in parallel and rewrites the report from all summaries.
+
+    :param workers: The number of worker processes (default: one per CPU).
+    :param force: True to analyze every file again.
+    """
+    # Create the images directory if it doesn't exist
+    if not os.path.exists(images_dir):
+        os.makedirs(images_dir)
+
+    cache = {} if force else load_cache()
+    filenames = list_result_files()
+
+    summaries = {}
+    pending = []
+    for filename in filenames:
+        path = os.path.join(results_dir, filename)
+        key = f'{os.path.getmtime(path)}:{os.path.getsize(path)}'
+        entry = cache.get(path)
+        if entry and entry['key'] == key and (entry['summary'] is None or (entry['summary']['graph'] == graph_path(filename)
+                                                                          and os.path.exists(entry['summary']['graph']))):
+            summaries[filename] = entry['summary']
+        else:
+            pending.append((filename, path, key))
+
+    print(f"{len(filenames)} results file(s), {len(pending)} new or changed")
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for (filename, path, key), summary in zip(pending, executor.map(analyze_file, [p[0] for p in pending])):
+                summaries[filename] = summary
+                cache[path] = {'key': key, 'summary': summary}
+
+    # Forget files that were removed
+    cache = {path: entry for path, entry in cache.items() if os.path.exists(path)}
+    with open(cache_file, 'w') as file:
+        json.dump(cache, file, indent=1)
+
+    # Open a file to save the statistical information
+    with open('statistical_analysis_results.txt', 'w') as result_file:
+        for filename in filenames:
+            summary = summaries[filename]
+            if summary is None:
+                continue
+
+            # Write the statistical information to the result file
+            result_file.write(f"Processing file: {filename}\n")
+            result_file.write(f"Image file: {summary['image']}\n")
+            result_file.write(f"NINA Power mode configuration: {summary['power_mode']}\n")
+            result_file.write(f"Mean: {summary['mean']:.2f} ms\n")
+            result_file.write(f"Median: {summary['median']:.2f} ms\n")
+            result_file.write(f"Standard Deviation: {summary['std']:.2f} ms\n")
+            result_file.write(f"Variance: {summary['var']:.2f} ms\n\n")
+
+def load_table():
+    """
+    Loads every structured HTTP run into one table: a single array per field, all runs concatenated.
+
+    :return: A dictionary of field name -> array.
+    """
+    runs = [http_rows(load_arrays(os.path.join(results_dir, f))) for f in list_result_files() if f.endswith('.jsonl')]
+    runs = [run for run in runs if len(run['image'])]
+    if not runs:
+        return {name: np.array([]) for name in RESULT_FIELDS}
+    return {name: np.concatenate([run[name] for run in runs]) for name in RESULT_FIELDS}
+
+def group_rows(table):
+    """
+    Groups the rows of the table by the GROUP_FIELDS: power mode, direction, connection mode,
+    concurrency, segments, HTTP engine and image size.
+
+    :param table: The table returned by load_table.
+    :return: (group keys as tuples of the GROUP_FIELDS values, group index of every row)
+    """
+    # Combine the per-field value codes into one integer code per row
+    uniques = []
+    codes = np.zeros(len(table['size_bytes']), dtype=np.int64)
+    for name in GROUP_FIELDS:
+        values, index = np.unique(table[name], return_inverse=True)
+        uniques.append(values)
+        codes = codes * len(values) + index.ravel()
+    keys, group_index = np.unique(codes, return_inverse=True)
+
+    groups = []
+    for key in keys:
+        group = []
+        for values in reversed(uniques):
+            group.append(values[key % len(values)].item())
+            key //= len(values)
+        groups.append(tuple(reversed(group)))
+    return groups, group_index.ravel()
+
+def sort_by_group(values, group_index, group_count):
+    """
+    Sorts the values by group, and by value within every group.
+
+    :param values: The values of every row.
+    :param group_index: The group index of every row.
+    :param group_count: The number of groups.
+    :return: (sorted values, start of every group, size of every group)
+    """
+    order = np.lexsort((values, group_index))
+    counts = np.bincount(group_index, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return values[order], starts, counts
+
+def grouped_percentiles(sorted_values, starts, counts, q):
+    """
+    Computes a percentile of every group at once, interpolating linearly like np.percentile.
+
+    :param sorted_values: The values, sorted by group and by value (see sort_by_group).
+    :param starts: The start of every group.
+    :param counts: The size of every group.
+    :param q: The percentile (0-100).
+    :return: The percentile of every group. Works on a (resamples, rows) array too.
+    """
+    position = starts + (counts - 1) * q / 100
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, starts + counts - 1)
+    fraction = position - lower
+    return sorted_values[..., lower] * (1 - fraction) + sorted_values[..., upper] * fraction
+
+def bootstrap_percentile_ci(sorted_values, starts, counts, group_index, q=50, resamples=1000, confidence=95, seed=0):
+    """
+    Bootstraps a confidence interval of a percentile of every group at once.
+
+    Every resample draws, for every row, a random row of the same group. As the values
+    are sorted within their group, sorting the drawn positions sorts the resampled values.
+    Resamples are drawn in chunks of BOOTSTRAP_CHUNK_ELEMENTS values, so memory does not
+    grow with resamples x rows.
+
+    :param sorted_values: The values, sorted by group and by value (see sort_by_group).
+    :param starts: The start of every group.
+    :param counts: The size of every group.
+    :param group_index: The group index of every sorted row.
+    :param q: The percentile (0-100).
+    :param resamples: The number of bootstrap resamples.
+    :param confidence: The confidence level in percent.
+    :param seed: The random seed.
+    :return: (lower bounds, upper bounds) of every group.
+    """
+    rng = np.random.default_rng(seed)
+    group_starts = starts[group_index]
+    group_counts = counts[group_index]
+    chunk = max(1, BOOTSTRAP_CHUNK_ELEMENTS // max(1, len(sorted_values)))
+    estimates = []
+    for done in range(0, resamples, chunk):
+        positions = group_starts + np.floor(rng.random((min(chunk, resamples - done), len(sorted_values)))
+                                            * group_counts).astype(int)
+        positions.sort(axis=1)
+        estimates.append(grouped_percentiles(sorted_values[positions], starts, counts, q))
+    estimates = np.concatenate(estimates)
+    alpha = (100 - confidence) / 2
+    return np.percentile(estimates, alpha, axis=0), np.percentile(estimates, 100 - alpha, axis=0)
+
+def plot_comparison(groups, times, times_ci, throughputs, output_filename):
+    """
+    Plots the median transfer time with its confidence interval and the throughput distribution of every group.
+
+    :param groups: The group keys (see GROUP_FIELDS).
+    :param times: The median transfer time of every group.
+    :param times_ci: (lower bounds, upper bounds) of the median transfer times.
+    :param throughputs: The throughput samples of every group.
+    :param output_filename: The image file to write.
+    """
+    labels = [f"{power_mode}\n{direction} {size / 1024:.0f} KB\n{connection_mode} {engine} c{concurrency} s{segments}"
+              for power_mode, direction, connection_mode, concurrency, segments, engine, size in groups]
+    x = np.arange(len(groups))
+
+    fig, (ax_time, ax_throughput) = plt.subplots(1, 2, figsize=(max(10, 2 * len(groups)), 6))
+    ax_time.bar(x, times, color='g', alpha=0.6)
+    ax_time.errorbar(x, times, yerr=[times - times_ci[0], times_ci[1] - times], fmt='none', ecolor='k', capsize=4)
+    ax_time.set_xticks(x, labels, fontsize=8)
+    ax_time.set_ylabel('Median Transfer Time (ms)')
+    ax_time.set_title('Median transfer time (95% bootstrap CI)', fontdict={'fontsize': 12, 'fontweight': 'bold'})
+
+    ax_throughput.boxplot(throughputs, positions=x, whis=(1, 99), showfliers=False)
+    ax_throughput.set_xticks(x, labels, fontsize=8)
+    ax_throughput.set_ylabel('Throughput (Mbps)')
+    ax_throughput.set_title('Throughput distribution (p1-p99)', fontdict={'fontsize': 12, 'fontweight': 'bold'})
+
+    fig.tight_layout()
+    fig.savefig(output_filename)
+    plt.close(fig)
+
+def compare(resamples=1000):
+    """
+    Compares all structured runs grouped by power mode, direction, connection mode, concurrency,
+    segments, HTTP engine and image size: transfer time and throughput percentiles, and a bootstrap confidence interval of the median transfer time.
+    Writes the comparison table and the summary figure.
+
+    :param resamples: The number of bootstrap resamples.
+    """
+    table = load_table()
+    if len(table['image']) == 0:
+        print("No structured results to compare")
+        return
+
+    groups, group_index = group_rows(table)
+    times, starts, counts = sort_by_group(table['transfer_time_ms'], group_index, len(groups))
+    throughputs, _, _ = sort_by_group(table['throughput_mbps'], group_index, len(groups))
+    sorted_group_index = np.repeat(np.arange(len(groups)), counts)
+
+    time_percentiles = {q: grouped_percentiles(times, starts, counts, q) for q in PERCENTILES}
+    throughput_percentiles = {q: grouped_percentiles(throughputs, starts, counts, q) for q in PERCENTILES}
+    times_ci = bootstrap_percentile_ci(times, starts, counts, sorted_group_index, 50, resamples)
+    mean_throughputs = np.bincount(sorted_group_index, weights=throughputs) / counts
+
+    header = (list(GROUP_FIELDS) + ['samples']
+              + [f'transfer_p{q}_ms' for q in PERCENTILES] + ['transfer_p50_ci_low_ms', 'transfer_p50_ci_high_ms']
+              + ['throughput_mean_mbps'] + [f'throughput_p{q}_mbps' for q in PERCENTILES])
+    with open(comparison_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for i, group in enumerate(groups):
+            writer.writerow(list(group) + [counts[i]]
+                            + [f'{time_percentiles[q][i]:.3f}' for q in PERCENTILES]
+                            + [f'{times_ci[0][i]:.3f}', f'{times_ci[1][i]:.3f}', f'{mean_throughputs[i]:.3f}']
+                            + [f'{throughput_percentiles[q][i]:.3f}' for q in PERCENTILES])
+
+    print(f"{'Power mode':<20} {'Direction':<9} {'Connection':<10} {'Engine':<11} {'Conc':>4} {'Seg':>3} "
+          f"{'Size':>10} {'N':>6} {'p50 ms':>9} {'95% CI':>19} {'p90 ms':>9} {'p99 ms':>9} {'p50 Mbps':>9}")
+    for i, (power_mode, direction, connection_mode, concurrency, segments, engine, size) in enumerate(groups):
+        ci = f"{times_ci[0][i]:.2f}-{times_ci[1][i]:.2f}"
+        print(f"{power_mode:<20} {direction:<9} {connection_mode:<10} {engine:<11} {concurrency:>4} {segments:>3} "
+              f"{size:>10} {counts[i]:>6} {time_percentiles[50][i]:>9.2f} {ci:>19} "
+              f"{time_percentiles[90][i]:>9.2f} {time_percentiles[99][i]:>9.2f} {throughput_percentiles[50][i]:>9.2f}")
+
+    if not os.path.exists(images_dir):
+        os.makedirs(images_dir)
+    plot_comparison(groups, time_percentiles[50], times_ci,
+                    np.split(throughputs, np.cumsum(counts)[:-1]), comparison_graph)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Statistical analysis of the HTTP download results")
+    parser.add_argument("--workers", type=int, help="Number of worker processes rendering the plots (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="Analyze every results file again, ignoring the cache")
+    parser.add_argument("--compare", action="store_true", help="Also compare all runs grouped by power mode, direction, connection mode, concurrency, segments, HTTP engine and image size")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="Number of bootstrap resamples of the comparison (default: 1000)")
+    args = parser.parse_args()
+
+    analyze(args.workers, args.force)
+    if args.compare:
+        compare(args.bootstrap)
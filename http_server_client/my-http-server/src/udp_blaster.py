@@ -0,0 +1,283 @@
+import os
+import time
+import errno
+import random
+import socket
+import struct
+import argparse
+from collections import deque
+from datetime import datetime
+from colorama import Fore, Style, init
+from result_records import make_record, append_records
+
+port = 5202
+results_dir = 'results'
+
+# Datagram header: test ID, sequence number, send time (sender's perf_counter_ns), target rate in kbit/s.
+# The rest of the datagram is padding up to the chosen size.
+HEADER = struct.Struct('!IIQI')
+END_SEQUENCE = 0xFFFFFFFF  # End of test marker; its send time field carries the number of datagrams sent
+END_REPEAT = 5  # The end marker can be lost too
+IDLE_TIMEOUT = 2.0  # Seconds without datagrams that end a test
+FINISHED_TESTS = 16  # IDs of finished tests remembered, so late datagrams and repeated end markers are ignored
+
+init(autoreset=True)
+
+def mbps(byte_count, seconds):
+    return (byte_count * 8) / seconds / (1024 * 1024) if seconds > 0 else 0.0
+
+def send(host, rate_mbps, size, duration):
+    """
+    Sends sequence-numbered, timestamped datagrams at a target rate.
+
+    :param host: The receiver IP address.
+    :param rate_mbps: The target rate in Mbps.
+    :param size: The datagram size in bytes (at least the header size).
+    :param duration: The test duration in seconds.
+    """
+    test_id = random.getrandbits(32)
+    rate_kbps = round(rate_mbps * 1024)
+    gap_ns = size * 8 / (rate_mbps * 1024 * 1024) * 1e9
+    buffer = bytearray(size)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((host, port))
+        sent = 0
+        dropped = 0  # Datagrams the local stack refused (ENOBUFS)
+        start = time.perf_counter_ns()
+        end = start + int(duration * 1e9)
+        next_send = start
+        while (now := time.perf_counter_ns()) < end:
+            if now < next_send:
+                ahead = next_send - now
+                if ahead > 1_000_000:
+                    time.sleep((ahead - 500_000) / 1e9)  # Sleep, leaving the last half millisecond to spin
+                continue
+            HEADER.pack_into(buffer, 0, test_id, sent, now, rate_kbps)
+            try:
+                sock.send(buffer)
+            except OSError as error:
+                if error.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    raise
+                dropped += 1
+            sent += 1
+            next_send += gap_ns
+        elapsed = (time.perf_counter_ns() - start) / 1e9
+
+        HEADER.pack_into(buffer, 0, test_id, END_SEQUENCE, sent, rate_kbps)
+        for _ in range(END_REPEAT):
+            sock.send(buffer[:HEADER.size])
+            time.sleep(0.01)
+
+    print(f'{Fore.GREEN}Test {test_id:08x}: sent {sent} datagrams of {size} bytes in {elapsed:.2f} s '
+          f'({mbps(sent * size, elapsed):.2f} Mbps, target {rate_mbps} Mbps), {dropped} refused by the local stack')
+
+class UdpTest:
+    """
+    Receiver side statistics of one test: loss, reordering, RFC 3550 jitter and per-interval throughput.
+    """
+
+    def __init__(self, test_id, rate_kbps, size):
+        self.test_id = test_id
+        self.rate_kbps = rate_kbps
+        self.size = size
+        self.start_time = time.time()
+        self.first_arrival = None
+        self.last_arrival = None
+        self.received = 0
+        self.bytes = 0
+        self.highest = -1  # Highest sequence number received
+        self.reordered = 0  # Datagrams that arrived after a higher sequence number
+        self.duplicates = 0
+        self.seen = bytearray()  # One flag per sequence number, to tell late datagrams from duplicates
+        self.sent = None  # Known once the end marker arrives
+        self.jitter_ns = 0.0
+        self.last_transit = None
+        self.intervals = []
+        self.interval_start = None
+        self.interval_snapshot = (0, 0, -1, 0)  # (received, bytes, highest, reordered) at the interval start
+
+    def add(self, sequence, send_ns, arrival_ns, length):
+        if self.first_arrival is None:
+            self.first_arrival = self.interval_start = arrival_ns
+        self.last_arrival = arrival_ns
+
+        if sequence >= len(self.seen):
+            self.seen.extend(bytes(sequence + 1 - len(self.seen) + 4096))
+        if self.seen[sequence]:
+            self.duplicates += 1
+            return
+        self.seen[sequence] = 1
+        self.received += 1
+        self.bytes += length
+        if sequence < self.highest:
+            self.reordered += 1
+        else:
+            self.highest = sequence
+
+        # RFC 3550 interarrival jitter: J += (|D(i-1, i)| - J) / 16, with D the change in transit time.
+        # The clocks of both hosts need not agree, as only transit time differences are used.
+        transit = arrival_ns - send_ns
+        if self.last_transit is not None:
+            self.jitter_ns += (abs(transit - self.last_transit) - self.jitter_ns) / 16
+        self.last_transit = transit
+
+    def close_interval(self, now_ns):
+        """
+        Closes the current interval and returns its statistics.
+
+        :param now_ns: The end of the interval (perf_counter_ns).
+        :return: A dictionary with the interval statistics, or None before the first datagram.
+        """
+        if self.interval_start is None:
+            return None
+        received, byte_count, highest, reordered = self.interval_snapshot
+        seconds = (now_ns - self.interval_start) / 1e9
+        expected = self.highest - highest
+        interval = {
+            'start_s': (self.interval_start - self.first_arrival) / 1e9,
+            'end_s': (now_ns - self.first_arrival) / 1e9,
+            'received': self.received - received,
+            'lost': max(0, expected - (self.received - received)),
+            'reordered': self.reordered - reordered,
+            'jitter_ms': self.jitter_ns / 1e6,
+            'throughput_mbps': mbps(self.bytes - byte_count, seconds),
+        }
+        self.intervals.append(interval)
+        self.interval_start = now_ns
+        self.interval_snapshot = (self.received, self.bytes, self.highest, self.reordered)
+        return interval
+
+    def summary(self):
+        # Without the end marker, datagrams lost after the highest one received are not counted
+        expected = self.sent if self.sent is not None else self.highest + 1
+        lost = max(0, expected - self.received)
+        return {
+            'expected': expected,
+            'lost': lost,
+            'loss_pct': 100 * lost / expected if expected else 0.0,
+            'elapsed': (self.last_arrival - self.first_arrival) / 1e9 if self.first_arrival else 0.0,
+        }
+
+def print_interval(interval):
+    print(f'{Fore.CYAN}{interval["start_s"]:7.2f}-{interval["end_s"]:7.2f} s  {interval["throughput_mbps"]:9.2f} Mbps  '
+          f'received {interval["received"]:7d}  lost {interval["lost"]:6d}  reordered {interval["reordered"]:5d}  '
+          f'jitter {interval["jitter_ms"]:7.3f} ms')
+
+def finish_test(test, power_mode, direction):
+    """
+    Prints the summary of a test and writes its result record and intervals.
+
+    :param test: The UdpTest.
+    :param power_mode: The NINA power mode configuration used during the test.
+    :param direction: downlink or uplink, as seen from the host.
+    """
+    summary = test.summary()
+    throughput = mbps(test.bytes, summary['elapsed'])
+    print(f'{Fore.GREEN}Test {test.test_id:08x}: received {test.received}/{summary["expected"]} datagrams '
+          f'({summary["loss_pct"]:.2f}% lost, {test.reordered} reordered, {test.duplicates} duplicated), '
+          f'{throughput:.2f} Mbps delivered, jitter {test.jitter_ns / 1e6:.3f} ms')
+
+    name = f'udp_{test.size}b_{test.rate_kbps}kbps'
+    stamp = datetime.fromtimestamp(test.start_time).strftime('%Y.%m.%d.%H.%M.%S')
+    result_file_path = os.path.join(results_dir, f'{stamp}_{name}_results.jsonl')
+    os.makedirs(results_dir, exist_ok=True)
+    append_records(result_file_path, [make_record(
+        timestamp=test.start_time,
+        start_time=datetime.fromtimestamp(test.start_time).strftime('%Y-%m-%d %H:%M:%S:%f'),
+        request_id=f'{test.test_id:08x}',
+        direction=direction,
+        image=name,
+        size_bytes=test.bytes,
+        power_mode=power_mode,
+        connection_mode='udp',
+        http_engine='udp',
+        transfer_time_ms=summary['elapsed'] * 1000,
+        throughput_mbps=throughput,
+        packets=test.received,
+        lost_packets=summary['lost'],
+        reordered_packets=test.reordered,
+        jitter_ms=test.jitter_ns / 1e6,
+    )])
+    append_records(os.path.splitext(result_file_path)[0] + '_intervals.jsonl', test.intervals)
+    print(f'{Fore.GREEN}Results saved to {result_file_path}')
+
+def receive(interval_ms, power_mode, direction):
+    """
+    Receives tests until interrupted, reporting every interval and writing one result record per test.
+
+    :param interval_ms: The report interval in ms.
+    :param power_mode: The NINA power mode configuration used during the test.
+    :param direction: downlink or uplink, as seen from the host.
+    """
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+    test = None
+    finished = deque(maxlen=FINISHED_TESTS)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(('', port))
+        sock.settimeout(interval_ms / 1000)
+        print(f'{Fore.GREEN}Receiving UDP tests on port {port}...')
+        while True:
+            try:
+                length = sock.recv_into(buffer)
+                arrival = time.perf_counter_ns()
+            except socket.timeout:
+                length = 0
+                arrival = time.perf_counter_ns()
+
+            # Late datagrams and repeated end markers of finished tests are ignored
+            if length >= HEADER.size and HEADER.unpack_from(view)[0] not in finished:
+                test_id, sequence, send_ns, rate_kbps = HEADER.unpack_from(view)
+                if test is None or test_id != test.test_id:
+                    if test is not None:
+                        finish_test(test, power_mode, direction)
+                        finished.append(test.test_id)
+                    if sequence == END_SEQUENCE:
+                        test = None
+                        continue  # End marker of a test whose datagrams were all lost
+                    print(f'{Fore.YELLOW}-----------------------------------------------------------')
+                    print(f'{Fore.BLUE}Test {test_id:08x}: {length}-byte datagrams at {rate_kbps / 1024:.2f} Mbps')
+                    test = UdpTest(test_id, rate_kbps, length)
+                if sequence == END_SEQUENCE:
+                    test.sent = send_ns
+                else:
+                    test.add(sequence, send_ns, arrival, length)
+
+            if test is None or test.interval_start is None:
+                continue
+            if arrival - test.interval_start >= interval_ms * 1e6:
+                print_interval(test.close_interval(arrival))
+            if test.sent is not None or (arrival - test.last_arrival) / 1e9 > IDLE_TIMEOUT:
+                if test.interval_start < test.last_arrival:
+                    print_interval(test.close_interval(test.last_arrival))
+                finish_test(test, power_mode, direction)
+                finished.append(test.test_id)
+                test = None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP loss, reordering and jitter test of the Wi-Fi link")
+    parser.add_argument("mode", choices=["send", "receive"], help="send: blast datagrams at the receiver, receive: measure them")
+    parser.add_argument("--host", help="Receiver IP address (send mode)")
+    parser.add_argument("--port", type=int, default=port, help=f"UDP port (default: {port})")
+    parser.add_argument("--rate", type=float, default=10, help="Target rate in Mbps (send mode, default: 10)")
+    parser.add_argument("--size", type=int, default=1200, help=f"Datagram size in bytes, at least {HEADER.size} (send mode, default: 1200)")
+    parser.add_argument("--duration", type=float, default=10, help="Test duration in seconds (send mode, default: 10)")
+    parser.add_argument("--interval", type=float, default=1000, help="Report interval in ms (receive mode, default: 1000)")
+    parser.add_argument("--power_mode", default="AT+UWCFG=1,0", help="NINA power mode configuration used during the test, written to the results (receive mode)")
+    parser.add_argument("--direction", choices=["downlink", "uplink"], default="downlink", help="Direction of the test as seen from the host, written to the results (receive mode, default: downlink)")
+    args = parser.parse_args()
+
+    port = args.port
+    if args.mode == "send":
+        if not args.host:
+            parser.error("send mode needs --host")
+        if args.size < HEADER.size:
+            parser.error(f"--size must be at least {HEADER.size} bytes")
+        send(args.host, args.rate, args.size, args.duration)
+    else:
+        try:
+            receive(args.interval, args.power_mode, args.direction)
+        except KeyboardInterrupt:
+            pass
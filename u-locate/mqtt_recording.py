@@ -0,0 +1,110 @@
+import os
+import struct
+import time
+
+# A recording starts with MAGIC, followed by one record per message: the header, the topic
+# (UTF-8) and the payload. The header holds the receive time (time.time_ns()), the topic
+# length and the payload length.
+MAGIC = b'MQTTREC1'
+HEADER = struct.Struct('!QHI')
+FLUSH_EVERY = 1000  # Messages buffered at most before they are written to the file
+FLUSH_INTERVAL = 1.0  # Seconds a message stays buffered at most, when Recorder.flush is called on a timer
+
+def complete_length(path):
+    """
+    Returns the length of a recording up to the end of its last complete record.
+
+    :param path: The recording file.
+    :return: The length in bytes, or 0 for an empty file or one cut off inside MAGIC.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        magic = file.read(len(MAGIC))
+        if magic != MAGIC:
+            if size < len(MAGIC) and MAGIC.startswith(magic):
+                return 0
+            raise ValueError(f"{path} is not an MQTT recording")
+        end = len(MAGIC)
+        while True:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return end
+            _, topic_length, payload_length = HEADER.unpack(header)
+            record_end = end + HEADER.size + topic_length + payload_length
+            if record_end > size:
+                return end
+            file.seek(record_end)
+            end = record_end
+
+class Recorder:
+    """
+    Appends received messages to a binary recording.
+
+    Messages are appended, so a recording can be extended by later runs. A partly written
+    record left at the end by a killed run is cut off before appending, so the messages
+    after it stay readable. Messages are buffered and written every FLUSH_EVERY messages
+    and on every flush(); a killed run loses the messages since the last write.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The recording file. It is created if it does not exist.
+        """
+        self.path = path
+        if os.path.exists(path):
+            length = complete_length(path)
+            if length < os.path.getsize(path):
+                os.truncate(path, length)
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.messages = 0
+        self.buffered = 0
+
+    def write(self, topic, payload):
+        """
+        Appends one message, stamped with the current time.
+
+        :param topic: The topic (str).
+        :param payload: The payload (bytes).
+        """
+        topic = topic.encode()
+        self.file.write(HEADER.pack(time.time_ns(), len(topic), len(payload)))
+        self.file.write(topic)
+        self.file.write(payload)
+        self.messages += 1
+        self.buffered += 1
+        if self.buffered >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered messages to the file.
+        """
+        if self.buffered:
+            self.file.flush()
+            self.buffered = 0
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path):
+    """
+    Yields the messages of a recording. A partly written last record is ignored.
+
+    :param path: The recording file.
+    :return: An iterator of (timestamp in ns, topic, payload) tuples.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an MQTT recording")
+        while True:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            timestamp, topic_length, payload_length = HEADER.unpack(header)
+            topic = file.read(topic_length)
+            payload = file.read(payload_length)
+            if len(payload) < payload_length:
+                return
+            yield timestamp, topic.decode(), payload
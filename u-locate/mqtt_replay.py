@@ -0,0 +1,113 @@
+import asyncio
+import uuid
+from gmqtt import Client as MQTTClient
+from colorama import init, Fore, Style
+from mqtt_recording import read_recording
+import time
+import argparse
+
+# Initialize colorama
+init(autoreset=True)
+
+YIELD_EVERY = 100  # Messages published back to back before letting the event loop send them
+
+def print_recording_info(path):
+    """
+    Prints the number of messages, the duration and the messages per topic of a recording.
+
+    :param path: The recording file.
+    """
+    topics = {}
+    first = last = None
+    size = 0
+    for timestamp, topic, payload in read_recording(path):
+        first = timestamp if first is None else first
+        last = timestamp
+        topics[topic] = topics.get(topic, 0) + 1
+        size += len(payload)
+    messages = sum(topics.values())
+    if not messages:
+        print(f"{Fore.YELLOW}{path} holds no messages")
+        return
+    duration = (last - first) / 1e9
+    print(f"{Fore.GREEN}{path}: {messages} messages, {size} payload bytes over {duration:.1f} s "
+          f"({messages / duration if duration else 0:.1f} msgs/s)")
+    for topic, count in sorted(topics.items()):
+        print(f"{Fore.CYAN}  {topic}: {count} messages")
+
+async def replay(broker, port, path, speed, topic=None, qos=0):
+    """
+    Republishes a recording, keeping the relative timing of the messages.
+
+    :param broker: The MQTT broker address.
+    :param port: The MQTT broker port.
+    :param path: The recording file.
+    :param speed: The replay speed factor (1 for real time, 0 for as fast as possible).
+    :param topic: Publish every message to this topic instead of the recorded one.
+    :param qos: The QoS of the published messages.
+    :return: The number of messages published.
+    """
+    client = MQTTClient(f"mqtt_replay-{uuid.uuid4().hex[:12]}")
+    await client.connect(broker, port)
+    print(f"{Fore.GREEN}Connected to MQTT Broker!")
+    print(f"{Fore.YELLOW}Replaying {path} at " + (f"{speed:g}x speed..." if speed else "maximum speed..."))
+
+    published = 0
+    max_lag = 0.0  # Longest time a message was published behind its schedule
+    start = time.perf_counter()
+    first = None
+    try:
+        for timestamp, recorded_topic, payload in read_recording(path):
+            if first is None:
+                first = timestamp
+            if speed:
+                # Every message is scheduled from the start, so delays do not add up
+                due = start + (timestamp - first) / 1e9 / speed
+                ahead = due - time.perf_counter()
+                if ahead > 0.001:
+                    await asyncio.sleep(ahead)
+                else:
+                    max_lag = max(max_lag, -ahead)
+                    if published % YIELD_EVERY == 0:
+                        await asyncio.sleep(0)
+            elif published % YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            client.publish(topic or recorded_topic, payload, qos=qos)
+            published += 1
+    finally:
+        elapsed = time.perf_counter() - start
+        await client.disconnect()
+        print(f"{Fore.GREEN}Published {published} messages in {elapsed:.2f} s "
+              f"({published / elapsed if elapsed else 0:.1f} msgs/s)")
+        if speed:
+            print(f"{Fore.BLUE}Longest delay behind the recorded timing: {max_lag * 1000:.1f} ms")
+    return published
+
+async def main(args):
+    for _ in range(args.loop):
+        await replay(args.broker_ip, args.port, args.file, args.speed, args.topic, args.qos)
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Replays an MQTT recording made with mqtt_tester.py --record")
+    parser.add_argument("file", type=str, help="Recording file")
+    parser.add_argument("-b", "--broker_ip", type=str, help="MQTT broker address")
+    parser.add_argument("-p", "--port", type=int, default=1883, help="MQTT broker port (default: 1883)")
+    parser.add_argument("--speed", type=float, default=1, help="Replay speed factor: 1 for real time, N for N times faster, 0 for as fast as possible (default: 1)")
+    parser.add_argument("--topic", type=str, help="Publish to this topic instead of the recorded topics")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0, help="QoS of the published messages (default: 0)")
+    parser.add_argument("--loop", type=int, default=1, help="Number of times to replay the recording (default: 1)")
+    parser.add_argument("--info", action="store_true", help="Only print what the recording holds")
+    args = parser.parse_args()
+
+    if args.info:
+        print_recording_info(args.file)
+    elif not args.broker_ip:
+        parser.error("replaying needs --broker_ip")
+    elif args.speed < 0:
+        parser.error("--speed must not be negative")
+    else:
+        try:
+            asyncio.run(main(args))
+        except KeyboardInterrupt:
+            print(f"{Fore.YELLOW}KeyboardInterrupt, exiting...")
@@ -1,92 +1,390 @@
 import asyncio
+import bisect
+import csv
 import json
+import re
+import uuid
+from array import array
+from datetime import datetime
 from gmqtt import Client as MQTTClient
 from colorama import init, Fore, Style
+from mqtt_recording import Recorder, FLUSH_INTERVAL
 import time
 import argparse
 
 # Initialize colorama
 init(autoreset=True)
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description="MQTT Connection Tester")
-parser.add_argument("-b", "--broker_ip", type=str, required=True, help="MQTT broker address")
-parser.add_argument("-p", "--port", type=int, required=True, help="MQTT broker port")
-parser.add_argument("-fk", "--filter_key", type=str, required=True, help="Filter key for the message")
-parser.add_argument("-fv", "--filter_values", type=str, nargs='+', required=True, help="Filter values for the message")
-parser.add_argument("-t", "--timeout", type=int, default=20, help="Timeout duration in seconds (default: 20)")
-args = parser.parse_args()
-
-# Define the MQTT broker details
-broker = args.broker_ip
-port = args.port
 topic = "angles"
-filter_key = args.filter_key
-filter_values = set(args.filter_values)  # Use a set for efficient lookups
-found_values = set()  # Track found filter values
-should_exit = False
-message_received = False
-timeout_duration = args.timeout
-
-# Define the callback functions
-def on_connect(client, flags, rc, properties):
-    print(f"{Fore.GREEN}Connected to MQTT Broker!")
-    client.subscribe(topic)  # Subscribe to the topic 'angles'
-
-def on_disconnect(client, packet, exc=None):
-    print(f"{Fore.YELLOW}Disconnected from MQTT Broker")
-    global should_exit
-    should_exit = True
-
-def on_message(client, topic, payload, qos, properties):
-    global message_received
-    try:
-        payload = json.loads(payload.decode())
-        value = payload.get(filter_key)
-        if value in filter_values and value not in found_values:
+
+def compile_prefilter(values):
+    """
+    Compiles one byte pattern matching any of the values as a JSON string.
+
+    A payload without a match cannot contain a wanted value, so it is skipped without
+    decoding it. Matches are only candidates: the value may belong to another key.
+
+    :param values: The filter values still to find.
+    :return: The compiled pattern, or None if there is nothing left to find.
+    """
+    if not values:
+        return None
+    # Non-ASCII values may arrive as UTF-8 or as \uXXXX escapes, depending on the publisher
+    encoded = {json.dumps(value, ensure_ascii=ascii_only)[1:-1].encode() for value in values for ascii_only in (False, True)}
+    alternatives = sorted((re.escape(value) for value in encoded), key=len, reverse=True)
+    return re.compile(b'"(?:' + b'|'.join(alternatives) + b')"')
+
+def print_stats(seconds, messages, candidates, name=''):
+    """
+    Prints the message rate and the prefilter hit rate of an interval.
+
+    :param seconds: The length of the interval.
+    :param messages: The messages received during the interval.
+    :param candidates: The messages that passed the prefilter during the interval.
+    :param name: Prefix identifying the tester.
+    """
+    hit_rate = 100 * candidates / messages if messages else 0
+    print(f"{Fore.BLUE}{name}{messages / seconds:.1f} msgs/s, filter hit rate {hit_rate:.2f}% "
+          f"({candidates} of {messages} messages decoded)")
+
+# Upper edges of the inter-arrival time histogram bins in ms; the last bin holds everything above
+HISTOGRAM_EDGES_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+MAX_STREAMS = 4096  # Tag/anchor pairs tracked at most; messages of further pairs are only counted
+
+def compile_key_pattern(key):
+    """
+    Compiles a byte pattern capturing the raw JSON value of a key, a string or a bare number.
+
+    :param key: The JSON key.
+    :return: The compiled pattern.
+    """
+    return re.compile(b'"' + re.escape(json.dumps(key)[1:-1].encode()) + rb'"\s*:\s*("(?:[^"\\]|\\.)*"|[-+.\w]+)')
+
+class StreamStats:
+    """
+    Arrival statistics of the angles of one tag seen by one anchor, in a fixed amount of memory.
+    """
+
+    __slots__ = ('messages', 'bytes', 'min_size', 'max_size', 'first', 'last', 'histogram', 'gaps', 'max_gap',
+                 'reported')
+
+    def __init__(self, now):
+        self.messages = 0
+        self.bytes = 0
+        self.min_size = None
+        self.max_size = 0
+        self.first = now
+        self.last = None
+        self.histogram = array('I', bytes(4 * (len(HISTOGRAM_EDGES_MS) + 1)))  # Inter-arrival times per bin
+        self.gaps = 0  # Inter-arrival times above the gap threshold
+        self.max_gap = 0.0  # Longest inter-arrival time in ms
+        self.reported = 0  # Messages at the last periodic report
+
+    def add(self, now, size, gap_ms):
+        self.messages += 1
+        self.bytes += size
+        self.min_size = size if self.min_size is None else min(self.min_size, size)
+        self.max_size = max(self.max_size, size)
+        if self.last is not None:
+            interval = (now - self.last) * 1000
+            self.histogram[bisect.bisect_left(HISTOGRAM_EDGES_MS, interval)] += 1
+            if interval > gap_ms:
+                self.gaps += 1
+            self.max_gap = max(self.max_gap, interval)
+        self.last = now
+
+    def rate(self):
+        """
+        :return: The mean message rate in msgs/s since the first message.
+        """
+        return (self.messages - 1) / (self.last - self.first) if self.messages > 1 and self.last > self.first else 0.0
+
+    def percentile(self, fraction):
+        """
+        Estimates a percentile of the inter-arrival time from the histogram.
+
+        :param fraction: The percentile as a fraction (0.5 for the median).
+        :return: The upper edge in ms of the bin holding the percentile (inf for the last bin), or None without data.
+        """
+        total = sum(self.histogram)
+        if not total:
+            return None
+        count = 0
+        for edge, bin_count in zip(HISTOGRAM_EDGES_MS + (float('inf'),), self.histogram):
+            count += bin_count
+            if count >= fraction * total:
+                return edge
+
+class TagStats:
+    """
+    Per tag and anchor statistics of the angle stream: message rate, inter-arrival time
+    histogram, gaps and payload size.
+
+    The tag and anchor are read from the raw payload with byte patterns, so messages are
+    never decoded. Memory grows with the number of tag/anchor pairs, up to MAX_STREAMS,
+    and not with the length of the run.
+    """
+
+    def __init__(self, tag_key, anchor_key, gap_ms):
+        """
+        :param tag_key: The message key holding the tag ID.
+        :param anchor_key: The message key holding the anchor ID or name.
+        :param gap_ms: Inter-arrival times above this many ms count as gaps.
+        """
+        self.tag_pattern = compile_key_pattern(tag_key)
+        self.anchor_pattern = compile_key_pattern(anchor_key)
+        self.gap_ms = gap_ms
+        self.streams = {}  # (tag, anchor) raw JSON values -> StreamStats
+        self.unmatched = 0  # Messages without the tag or anchor key
+        self.untracked = 0  # Messages of pairs beyond MAX_STREAMS
+
+    def add(self, payload, now):
+        tag = self.tag_pattern.search(payload)
+        anchor = self.anchor_pattern.search(payload)
+        if tag is None or anchor is None:
+            self.unmatched += 1
+            return
+        key = (tag.group(1), anchor.group(1))
+        stream = self.streams.get(key)
+        if stream is None:
+            if len(self.streams) >= MAX_STREAMS:
+                self.untracked += 1
+                return
+            stream = self.streams[key] = StreamStats(now)
+        stream.add(now, len(payload), self.gap_ms)
+
+    def rows(self):
+        """
+        :return: One dictionary per tag/anchor pair, sorted by tag and anchor.
+        """
+        rows = []
+        for (tag, anchor), stream in sorted(self.streams.items()):
+            row = {
+                'tag': tag.decode(errors='replace').strip('"'),
+                'anchor': anchor.decode(errors='replace').strip('"'),
+                'messages': stream.messages,
+                'rate_msgs_s': round(stream.rate(), 3),
+                'p50_interval_ms': stream.percentile(0.5),
+                'p95_interval_ms': stream.percentile(0.95),
+                'max_interval_ms': round(stream.max_gap, 1),
+                'gaps': stream.gaps,
+                'mean_size_bytes': round(stream.bytes / stream.messages, 1),
+                'min_size_bytes': stream.min_size,
+                'max_size_bytes': stream.max_size,
+            }
+            edges = (0,) + HISTOGRAM_EDGES_MS
+            for index, count in enumerate(stream.histogram):
+                upper = HISTOGRAM_EDGES_MS[index] if index < len(HISTOGRAM_EDGES_MS) else 'inf'
+                row[f'interval_{edges[index]}_{upper}_ms'] = count
+            rows.append(row)
+        return rows
+
+    def print_table(self, seconds, name=''):
+        """
+        Prints one line per tag/anchor pair, with the message rate of the last interval.
+
+        :param seconds: The length of the interval since the last table.
+        :param name: Prefix identifying the tester.
+        """
+        print(f"{Fore.BLUE}{name}{'tag':<16} {'anchor':<16} {'msgs':>8} {'now/s':>7} {'mean/s':>7} "
+              f"{'p50 ms':>7} {'p95 ms':>7} {'max ms':>8} {f'gaps>{self.gap_ms:g}':>9} {'bytes':>6}")
+        for row, stream in zip(self.rows(), (self.streams[key] for key in sorted(self.streams))):
+            current = (stream.messages - stream.reported) / seconds
+            stream.reported = stream.messages
+            color = Fore.YELLOW if row['gaps'] else Fore.CYAN
+            print(f"{color}{name}{row['tag']:<16} {row['anchor']:<16} {row['messages']:>8} {current:>7.1f} "
+                  f"{row['rate_msgs_s']:>7.1f} {row['p50_interval_ms'] or '-':>7} {row['p95_interval_ms'] or '-':>7} "
+                  f"{row['max_interval_ms']:>8} {row['gaps']:>9} {row['mean_size_bytes']:>6.0f}")
+        if self.unmatched or self.untracked:
+            print(f"{Fore.YELLOW}{name}{self.unmatched} messages without tag or anchor, "
+                  f"{self.untracked} of untracked tag/anchor pairs")
+
+    def write(self, path):
+        """
+        Writes the statistics as CSV, one row per tag/anchor pair.
+
+        :param path: The CSV file.
+        """
+        rows = self.rows()
+        if not rows:
+            return
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+class MqttTester:
+    """
+    Waits on one MQTT connection until every filter value has been seen on the angles topic.
+
+    All state lives in the instance, so several testers can run in the same event loop.
+    Completion is signalled with an asyncio.Event, so run() returns as soon as the last
+    value arrives instead of on the next polling tick. With tag statistics or a recorder,
+    it runs until the timeout instead.
+    """
+
+    def __init__(self, broker, port, filter_key, filter_values, stats_interval=5, name='', tag_stats=None,
+                 recorder=None):
+        """
+        :param broker: The MQTT broker address.
+        :param port: The MQTT broker port.
+        :param filter_key: The message key to filter on.
+        :param filter_values: The values of the key to wait for.
+        :param stats_interval: Seconds between message rate reports (0 to disable).
+        :param name: Prefix of the printed lines, to tell several testers apart.
+        :param tag_stats: TagStats collecting per tag and anchor statistics of every message, or None.
+        :param recorder: Recorder writing every message to a recording, or None.
+        """
+        self.broker = broker
+        self.port = port
+        self.filter_key = filter_key
+        self.filter_values = set(filter_values)  # Use a set for efficient lookups
+        self.found_values = {}  # Found filter value -> seconds from subscribing until it was received
+        self.stats_interval = stats_interval
+        self.name = name
+        self.tag_stats = tag_stats
+        self.recorder = recorder
+        self.prefilter = compile_prefilter(self.filter_values)
+        # Message counters, to check that the tester keeps up with the broker
+        self.messages = 0
+        self.candidates = 0
+        self.start = None  # perf_counter() when subscribed
+        self.elapsed = None  # Seconds until all values were found
+        self.done = asyncio.Event()  # Set when all values are found or the connection drops
+        # The broker drops an older session with the same client ID, so every tester needs its own
+        self.client = MQTTClient(f"mqtt_tester-{uuid.uuid4().hex[:12]}")
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, flags, rc, properties):
+        print(f"{Fore.GREEN}{self.name}Connected to MQTT Broker!")
+        client.subscribe(topic)  # Subscribe to the topic 'angles'
+        self.start = time.perf_counter()
+
+    def on_disconnect(self, client, packet, exc=None):
+        print(f"{Fore.YELLOW}{self.name}Disconnected from MQTT Broker")
+        self.done.set()
+
+    def on_message(self, client, topic, payload, qos, properties):
+        self.messages += 1
+        if self.recorder is not None:
+            self.recorder.write(topic, payload)
+        if self.tag_stats is not None:
+            self.tag_stats.add(payload, time.perf_counter())
+        # Fast path: most messages carry none of the wanted values and are never decoded
+        if self.prefilter is None or not self.prefilter.search(payload):
+            return
+        self.candidates += 1
+        try:
+            payload = json.loads(payload)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print(f"{Fore.RED}{self.name}Failed to decode JSON message")
+            return
+        value = payload.get(self.filter_key) if isinstance(payload, dict) else None
+        if value in self.filter_values and value not in self.found_values:
+            elapsed = time.perf_counter() - self.start
             print(f"\n{Fore.CYAN}************************************************************")
-            print(f"{Fore.GREEN}Message received!")    
+            print(f"{Fore.GREEN}{self.name}Message received after {elapsed:.3f} s!")
             print(f"{Fore.CYAN}Received message from topic {topic}: {payload}")
             print(f"{Fore.CYAN}************************************************************\n")
-            found_values.add(value)
-            message_received = True
-            if found_values == filter_values:
-                print(f"{Fore.GREEN}All filter values found: {found_values}. Exiting...")
-                asyncio.create_task(client.disconnect())
-    except json.JSONDecodeError:
-        print(f"{Fore.RED}Failed to decode JSON message")
+            self.found_values[value] = elapsed
+            self.prefilter = compile_prefilter(self.filter_values - self.found_values.keys())
+            if self.prefilter is None:
+                self.elapsed = elapsed
+                if self.tag_stats is None and self.recorder is None:
+                    self.done.set()
+
+    async def report_stats(self):
+        last = (time.perf_counter(), 0, 0)  # (time, messages, candidates) at the last report
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            now = time.perf_counter()
+            print_stats(now - last[0], self.messages - last[1], self.candidates - last[2], self.name)
+            if self.tag_stats is not None:
+                self.tag_stats.print_table(now - last[0], self.name)
+            last = (now, self.messages, self.candidates)
 
-async def main():
-    client = MQTTClient("client_id")
+    async def flush_recording(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.recorder.flush()
 
-    # Assign the callback functions
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-    client.on_message = on_message
+    async def run(self, timeout):
+        """
+        Connects, waits until all filter values are found or the timeout expires, and disconnects.
 
-    # Connect to the MQTT broker
-    await client.connect(broker, port)
+        :param timeout: The timeout in seconds.
+        :return: True if all filter values were found.
+        """
+        await self.client.connect(self.broker, self.port)
+        print(f"{Fore.YELLOW}{self.name}Listening for messages for {timeout} seconds...")
+        reporter = asyncio.create_task(self.report_stats()) if self.stats_interval else None
+        flusher = asyncio.create_task(self.flush_recording()) if self.recorder is not None else None
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if reporter:
+                reporter.cancel()
+            if flusher:
+                flusher.cancel()
+            if self.client.is_connected:
+                await self.client.disconnect()
+            self.print_summary()
+        return self.elapsed is not None
 
-    start_time = time.time()
-    print(f"{Fore.YELLOW}Listening for messages for {timeout_duration} seconds...")
+    def print_summary(self):
+        found = ', '.join(f"{value} ({seconds:.3f} s)" for value, seconds in self.found_values.items())
+        if self.elapsed is not None:
+            print(f"{Fore.GREEN}{self.name}All filter values found in {self.elapsed:.3f} s: {found}")
+        elif self.found_values:
+            print(f"{Fore.YELLOW}{self.name}Exiting ...\nFound values: {found}, "
+                  f"missing: {self.filter_values - self.found_values.keys()}")
+        else:
+            print(f"{Fore.YELLOW}{self.name}No messages received based on the filter within the timeout period.")
+        if self.start is not None:
+            elapsed = time.perf_counter() - self.start
+            if elapsed > 0:
+                print(f"{Fore.BLUE}{self.name}Total: ", end='')
+                print_stats(elapsed, self.messages, self.candidates)
 
-    # Keep the script running to maintain the connection
+async def main(args):
+    tag_stats = None
+    if args.tag_stats:
+        tag_stats = TagStats(args.tag_key, args.filter_key, args.gap_ms)
+    recorder = Recorder(args.record) if args.record else None
+    tester = MqttTester(args.broker_ip, args.port, args.filter_key, args.filter_values, args.stats_interval,
+                        tag_stats=tag_stats, recorder=recorder)
     try:
-        while not should_exit:
-            if time.time() - start_time > timeout_duration:
-                if not message_received:
-                    print(f"{Fore.YELLOW}No messages received based on the filter within the timeout period.")
-                break
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        print(f"{Fore.YELLOW}KeyboardInterrupt, exiting...")
+        return await tester.run(args.timeout)
     finally:
-        if client.is_connected:
-            if found_values:
-                print(f"{Fore.GREEN}Timeout, exiting ...\nFound values: {found_values}")
-            else:
-                print(f"{Fore.YELLOW}Timeout, exiting ... No values found")
-            await client.disconnect()
+        if recorder is not None:
+            recorder.close()
+            print(f"{Fore.GREEN}{recorder.messages} messages appended to {recorder.path}")
+        if tag_stats is not None and tag_stats.streams:
+            path = args.stats_file or f"tag_stats_{datetime.now().strftime('%Y.%m.%d.%H.%M.%S')}.csv"
+            tag_stats.write(path)
+            print(f"{Fore.GREEN}Tag statistics of {len(tag_stats.streams)} tag/anchor pairs saved to {path}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="MQTT Connection Tester")
+    parser.add_argument("-b", "--broker_ip", type=str, required=True, help="MQTT broker address")
+    parser.add_argument("-p", "--port", type=int, required=True, help="MQTT broker port")
+    parser.add_argument("-fk", "--filter_key", type=str, required=True, help="Filter key for the message")
+    parser.add_argument("-fv", "--filter_values", type=str, nargs='+', required=True, help="Filter values for the message")
+    parser.add_argument("-t", "--timeout", type=int, default=20, help="Timeout duration in seconds (default: 20)")
+    parser.add_argument("-s", "--stats_interval", type=int, default=5, help="Seconds between message rate reports (default: 5, 0 to disable)")
+    parser.add_argument("--tag_stats", action="store_true", help="Collect per tag and anchor statistics of every message and run until the timeout")
+    parser.add_argument("--tag_key", type=str, default="instance_id", help="Message key holding the tag ID (default: instance_id)")
+    parser.add_argument("--gap_ms", type=float, default=1000, help="Inter-arrival time in ms above which a tag counts a gap (default: 1000)")
+    parser.add_argument("--record", type=str, help="Append every message to this recording file (see mqtt_replay.py) and run until the timeout")
+    parser.add_argument("--stats_file", type=str, help="CSV file for the tag statistics (default: tag_stats_<date>.csv)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print(f"{Fore.YELLOW}KeyboardInterrupt, exiting...")